@@ -6,6 +6,7 @@ from flask_login import LoginManager
 from flask_socketio import SocketIO
 from sqlalchemy import MetaData
 from config import config
+from app.webhook_queue import WebhookQueue
 
 # Naming convention for SQLite constraints
 naming_convention = {
@@ -20,8 +21,9 @@ db = SQLAlchemy(metadata=MetaData(naming_convention=naming_convention))
 migrate = Migrate()
 login_manager = LoginManager()
 socketio = SocketIO(async_mode='eventlet')
+webhook_queue = WebhookQueue()
 
-def create_app(config_name='default'):
+def create_app(config_name='default', test_config=None):
     # ทำให้ง่ายขึ้น: instance_relative_config=True จะบอกให้ Flask
     # มองหาโฟลเดอร์ 'instance' ที่ root level โดยอัตโนมัติ
     app = Flask(__name__, instance_relative_config=True)
@@ -29,6 +31,8 @@ def create_app(config_name='default'):
     # โหลด Config จาก object
     # Flask จะรู้ว่าต้องสร้าง instance folder ที่ไหนจาก flag ด้านบน
     app.config.from_object(config[config_name])
+    if test_config:
+        app.config.update(test_config)
     
     # สร้างโฟลเดอร์ instance (ที่เก็บ database) หากยังไม่มี
     try:
@@ -43,16 +47,56 @@ def create_app(config_name='default'):
         pass
 
     # Initialize extensions
+    from . import database
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = database.engine_options(app.config)
     db.init_app(app)
+    database.init_app(app, db)
     migrate.init_app(app, db, render_as_batch=True)
     login_manager.init_app(app)
-    socketio.init_app(app)
+    # ตั้ง SOCKETIO_MESSAGE_QUEUE เพื่อให้ emit จากทุก worker/เครื่องไปถึง client ทุก node
+    socketio.init_app(
+        app,
+        message_queue=app.config.get("SOCKETIO_MESSAGE_QUEUE"),
+        channel=app.config.get("SOCKETIO_CHANNEL", "flask-socketio"),
+    )
+    webhook_queue.init_app(app)
 
     login_manager.login_view = "main.login"
 
+    from . import instrumentation
+    instrumentation.init_app(app)
+
+    from .line_profiles import profile_cache
+    profile_cache.init_app(app)
+
+    from .line_clients import line_clients
+    line_clients.init_app(app)
+
+    from .storage import media_storage
+    media_storage.init_app(app)
+
+    from .user_cache import user_cache
+    user_cache.init_app(app)
+
+    from .quick_replies import quick_reply_index
+    quick_reply_index.init_app(app)
+
+    from . import search
+    search.init_app(app)
+
+    from . import index_audit
+    index_audit.init_app(app)
+
+    from . import unread
+    unread.init_app(app)
+
     # Import and register blueprints
     from . import routes
     app.register_blueprint(routes.bp)
 
+    # Socket.IO event handlers (join ห้องของ staff ตอน connect)
+    from . import realtime
+    realtime.init_app(app)
+
     return app
 
@@ -0,0 +1,109 @@
+import logging
+
+from eventlet.semaphore import Semaphore
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS ตามชนิดฐานข้อมูล (ค่าใน config ที่ตั้งเองจะทับค่าเหล่านี้)"""
+    uri = config.get("SQLALCHEMY_DATABASE_URI")
+    backend = make_url(uri).get_backend_name() if uri else None
+    if backend == "sqlite":
+        options = {
+            "poolclass": QueuePool,
+            "pool_size": config["SQLITE_POOL_SIZE"],
+            "max_overflow": config["SQLITE_POOL_OVERFLOW"],
+            # eventlet green thread ทุกตัวอยู่บน OS thread เดียวกัน แต่ connection ถูกส่งต่อกันผ่าน pool
+            "connect_args": {"check_same_thread": False, "timeout": config["SQLITE_BUSY_TIMEOUT_MS"] / 1000},
+        }
+    elif backend == "postgresql":
+        options = {
+            "poolclass": QueuePool,
+            "pool_size": config["DB_POOL_SIZE"],
+            "max_overflow": config["DB_POOL_OVERFLOW"],
+            "pool_timeout": config["DB_POOL_TIMEOUT"],
+            "pool_recycle": config["DB_POOL_RECYCLE"],
+            "pool_pre_ping": True,
+            "connect_args": {"options": f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT_MS']}"},
+        }
+    else:
+        options = {"pool_pre_ping": True}
+    options.update(config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+    return options
+
+
+class SQLiteWriteLock:
+    """ให้ green thread ใน process เดียวกันเขียน SQLite ทีละตัว
+
+    busy handler ของ SQLite รอแบบ blocking ทั้ง OS thread ถ้า green thread หนึ่งถือ write lock ค้างไว้
+    แล้วอีกตัวเข้าไปรอใน busy handler ตัวที่ถือ lock จะไม่ได้รันต่อจนหมด busy_timeout ("database is locked")
+    จึงให้รอกันที่ Semaphore ของ eventlet ก่อนคำสั่งเขียนแรกของ transaction แล้วปล่อยตอน commit/rollback
+    busy_timeout จึงเหลือไว้รอ process อื่นเท่านั้น
+    """
+
+    def __init__(self):
+        self._lock = Semaphore(1)
+
+    def install(self, engine, config):
+        busy_timeout = config["SQLITE_BUSY_TIMEOUT_MS"]
+        synchronous = config["SQLITE_SYNCHRONOUS"]
+
+        @event.listens_for(engine, "connect")
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout)}")
+            cursor.execute(f"PRAGMA synchronous={synchronous}")
+            cursor.close()
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def acquire_for_write(conn, cursor, statement, parameters, context, executemany):
+            if conn.info.get("sqlite_write_lock"):
+                return
+            if statement.lstrip()[:7].upper().startswith(WRITE_STATEMENTS):
+                # ถ้ารอนานเกิน busy_timeout (เช่น green thread เดียวกันเปิดสอง connection) ปล่อยให้ SQLite จัดการเอง
+                if self._lock.acquire(timeout=busy_timeout / 1000):
+                    conn.info["sqlite_write_lock"] = True
+
+        @event.listens_for(engine, "commit")
+        @event.listens_for(engine, "rollback")
+        def release_after_transaction(conn):
+            self._release(conn.info)
+
+        @event.listens_for(engine, "checkin")
+        def release_on_checkin(dbapi_connection, connection_record):
+            # กันกรณี connection ถูกคืน pool โดยไม่มี commit/rollback ผ่าน Connection
+            self._release(connection_record.info)
+
+    def _release(self, info):
+        if info.pop("sqlite_write_lock", False):
+            self._lock.release()
+
+
+def patch_postgres_driver():
+    # psycopg2 เป็น C extension ที่ eventlet monkey_patch ไม่ครอบคลุม query จะบล็อกทุก green thread
+    try:
+        import eventlet.patcher
+        from psycogreen.eventlet import patch_psycopg
+    except ImportError:
+        logger.warning("psycogreen is not installed: PostgreSQL queries will block the eventlet hub")
+        return
+    if eventlet.patcher.is_monkey_patched("socket"):
+        patch_psycopg()
+
+
+def init_app(app, db):
+    """ตั้งค่า engine ตามชนิดฐานข้อมูล ต้องเรียกหลัง db.init_app(app)"""
+    with app.app_context():
+        engine = db.engine
+        backend = engine.dialect.name
+        if backend == "sqlite":
+            SQLiteWriteLock().install(engine, app.config)
+        elif backend == "postgresql":
+            patch_postgres_driver()
@@ -0,0 +1,163 @@
+import datetime
+import re
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event
+
+from app import db
+
+indexes_cli = AppGroup("indexes", help="Inspect how the hot chat queries use indexes.")
+
+# ข้อความใน plan ที่แปลว่าอ่านทั้งตารางหรือต้อง sort เอง
+WARNINGS = {
+    "sqlite": [
+        (re.compile(r"\bSCAN (?!CONSTANT ROW)(?!.*\bUSING (COVERING )?INDEX\b)(?!.*\bVIRTUAL TABLE\b)"), "full table scan"),
+        (re.compile(r"USE TEMP B-TREE"), "sort without index"),
+    ],
+    "postgresql": [
+        (re.compile(r"Seq Scan"), "sequential scan"),
+        (re.compile(r"^\s*(->\s*)?Sort\b"), "sort without index"),
+    ],
+}
+
+# ชื่อ subquery ใน plan ของ SQLite
+SUBQUERY = re.compile(r"(?:CO-ROUTINE|MATERIALIZE) (\S+)")
+
+
+def sample_ids():
+    from app.models import User, Conversation
+
+    staff = User.query.filter(User.role.in_(['admin', 'staff', 'owner'])).order_by(User.id).first()
+    conv = Conversation.query.order_by(Conversation.id).first()
+    guest = conv.user if conv else User.query.filter_by(role='guest').order_by(User.id).first()
+    return {
+        "staff_id": staff.id if staff else 1,
+        "guest_id": guest.id if guest else 1,
+        "line_user_id": (guest.line_user_id if guest else None) or "U0",
+        "username": guest.username if guest else "guest",
+    }
+
+
+def audited_queries(ids):
+    """เรียกฟังก์ชันเดียวกับที่ route / worker ใช้จริง เพื่อให้ audit ตามโค้ดเสมอ
+
+    ฟังก์ชันที่เขียนข้อมูลไม่ commit เอง audit_command จะ rollback หลังแต่ละรายการ
+    cache ในหน่วยความจำถูกล้างก่อนเรียก เพื่อให้เห็น query ตอนโหลดใหม่
+    """
+    from linebot.models import Profile
+
+    from app import routes
+    from app.line_clients import line_clients
+    from app.models import Message
+    from app.quick_replies import quick_reply_index
+    from app.realtime import staff_roster
+
+    staff_id, guest_id = ids["staff_id"], ids["guest_id"]
+
+    def staff_members():
+        staff_roster.invalidate()
+        return staff_roster.members()
+
+    def customer_account():
+        line_clients.invalidate()
+        line_clients.account_for_customer(guest_id)
+
+    def resolve_users(display_name):
+        # ชื่อในโปรไฟล์ต่างจากที่บันทึกไว้ จึงรวม query ตรวจชื่อซ้ำด้วย
+        profile = Profile(display_name=display_name, user_id=ids["line_user_id"], picture_url=None)
+        routes.resolve_line_users({(None, ids["line_user_id"]): profile})
+
+    def ingest_counters():
+        last = Message.query.filter(Message.user_id == guest_id).order_by(Message.id.desc()).first()
+        if last is None:
+            return
+        routes.touch_conversation(guest_id, last)
+        routes.increment_unread(guest_id, staff_roster.members(), [last])
+
+    return [
+        ("chat_all: sidebar page", lambda: routes.conversation_page_query(staff_id, 1, 50).all()),
+        ("chat_all: history page", lambda: routes.fetch_history_page(guest_id, limit=50)),
+        ("api_chat_history: older page",
+         lambda: routes.fetch_history_page(guest_id, datetime.datetime.utcnow(), 2 ** 31, limit=50)),
+        ("chat_all: mark read", lambda: routes.mark_conversation_read(staff_id, guest_id)),
+        ("chat_all: unread counts", lambda: routes.get_unread_counts(guest_id)),
+        ("chat_all: customer's OA", customer_account),
+        ("staff roster (cache refresh)", staff_members),
+        ("webhook: already ingested LINE messages", lambda: routes.ingested_line_message_ids(["0"])),
+        ("webhook: resolve users", lambda: resolve_users(ids["username"] + " (audit)")),
+        ("webhook: conversation + unread counters", ingest_counters),
+        ("webhook: unread counts for emits", lambda: routes.get_unread_counts_for([guest_id])),
+        ("startup: pending outbound messages", routes.pending_outbound_messages),
+        ("startup: pending media downloads", routes.pending_media_downloads),
+        ("api_quick_replies: index load", lambda: (quick_reply_index.invalidate(), quick_reply_index.scope_list())),
+    ]
+
+
+def capture(fn):
+    statements = []
+
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        # INSERT ไม่มี plan ให้ดู ส่วน UPDATE/DELETE ต้องหาแถวด้วย index เหมือน SELECT
+        if statement.lstrip().upper().startswith(("SELECT", "WITH", "UPDATE", "DELETE")):
+            statements.append((statement, parameters))
+
+    engine = db.engine
+    event.listen(engine, "before_cursor_execute", listener)
+    try:
+        fn()
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    return statements
+
+
+def explain(statement, parameters):
+    dialect = db.engine.dialect.name
+    prefix = "EXPLAIN QUERY PLAN " if dialect == "sqlite" else "EXPLAIN "
+    rows = db.session.connection().exec_driver_sql(prefix + statement, parameters).fetchall()
+    if dialect == "sqlite":
+        return [row[-1] for row in rows]
+    return [row[0] for row in rows]
+
+
+def warnings_for(plan):
+    patterns = WARNINGS.get(db.engine.dialect.name, [])
+    # SCAN ของผลลัพธ์ subquery (CO-ROUTINE/MATERIALIZE ใน plan เดียวกัน) อ่านแถวที่ subquery คืนมา ไม่ใช่ตาราง
+    subqueries = {match.group(1) for match in map(SUBQUERY.match, plan) if match}
+    plan = [line for line in plan if not (line.startswith("SCAN ") and line.split()[1] in subqueries)]
+    return sorted({label for line in plan for pattern, label in patterns if pattern.search(line)})
+
+
+@indexes_cli.command("audit")
+@click.option("--show-sql", is_flag=True, help="Print each SQL statement before its plan.")
+@click.option("--strict", is_flag=True, help="Exit with status 1 if any plan needs a scan or a sort.")
+def audit_command(show_sql, strict):
+    """EXPLAIN every query issued by chat_all, the webhook worker and api_quick_replies."""
+    ids = sample_ids()
+    flagged = 0
+    try:
+        for name, fn in audited_queries(ids):
+            click.secho(f"== {name}", bold=True)
+            try:
+                statements = capture(fn)
+            finally:
+                db.session.rollback()
+            for statement, parameters in statements:
+                plan = explain(statement, parameters)
+                if show_sql:
+                    click.echo("   " + " ".join(statement.split()))
+                for line in plan:
+                    click.echo(f"   {line}")
+                warnings = warnings_for(plan)
+                if warnings:
+                    flagged += 1
+                    click.secho(f"   !! {', '.join(warnings)}", fg="yellow")
+    finally:
+        db.session.rollback()
+    click.echo(f"{flagged} statement(s) flagged.")
+    if strict and flagged:
+        raise SystemExit(1)
+
+
+def init_app(app):
+    app.cli.add_command(indexes_cli)
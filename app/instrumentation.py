@@ -0,0 +1,49 @@
+import logging
+from contextlib import contextmanager
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _record_statement(conn, cursor, statement, parameters, context, executemany):
+    # g แยกตาม app context จึงนับแยกกันได้แม้มีหลาย green thread พร้อมกัน
+    if not has_app_context():
+        return
+    for statements in g.get("_sql_recorders", ()):
+        statements.append(statement)
+
+
+@contextmanager
+def record_queries():
+    """เก็บ SQL ทุกคำสั่งที่รันภายใน block นี้ ใช้ตรวจจำนวน query ของ route / ฟังก์ชัน"""
+    statements = []
+    recorders = g.setdefault("_sql_recorders", [])
+    recorders.append(statements)
+    try:
+        yield statements
+    finally:
+        recorders.remove(statements)
+
+
+def init_app(app):
+    if not app.config.get("SQL_QUERY_COUNT"):
+        return
+
+    @app.before_request
+    def _start_request_recorder():
+        g._request_statements = []
+        g.setdefault("_sql_recorders", []).append(g._request_statements)
+
+    @app.after_request
+    def _report_request_queries(response):
+        statements = g.pop("_request_statements", None)
+        if statements is None:
+            return response
+        response.headers["X-SQL-Query-Count"] = str(len(statements))
+        threshold = app.config.get("SQL_QUERY_WARN_THRESHOLD")
+        if threshold and len(statements) > threshold:
+            logger.warning("%s %s issued %d SQL statements", request.method, request.path, len(statements))
+        return response
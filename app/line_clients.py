@@ -0,0 +1,192 @@
+import time
+from collections import OrderedDict, namedtuple
+from functools import partial
+
+import requests
+from requests.adapters import HTTPAdapter
+from linebot import LineBotApi, SignatureValidator
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+
+
+class PooledHttpClient(RequestsHttpClient):
+    """RequestsHttpClient ที่ใช้ requests.Session ร่วมกัน เพื่อใช้ connection keep-alive ไป api.line.me ซ้ำ
+
+    LineBotApi สร้าง http client เองด้วย http_client(timeout=...) จึงต้องส่งเป็น partial(PooledHttpClient, session)
+    """
+
+    def __init__(self, session, timeout=RequestsHttpClient.DEFAULT_TIMEOUT):
+        super().__init__(timeout=timeout)
+        self.session = session
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = self.session.get(url, headers=headers, params=params, stream=stream,
+                                    timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = self.session.post(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = self.session.delete(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = self.session.put(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+
+# สำเนาข้อมูล LineAccount ที่ใช้ได้นอก session ของ SQLAlchemy
+AccountRef = namedtuple("AccountRef", ["id", "name", "channel_id", "channel_secret", "channel_access_token"])
+
+
+class _AccountClients:
+    __slots__ = ("token", "secret", "api", "validator")
+
+    def __init__(self, token, secret, api, validator):
+        self.token = token
+        self.secret = secret
+        self.api = api
+        self.validator = validator
+
+
+class LineClientRegistry:
+    """LINE client ต่อ LineAccount.id ใช้ร่วมกันทั้ง process บน connection pool เดียว
+
+    ถ้า token/secret ของบัญชีเปลี่ยน client จะถูกสร้างใหม่อัตโนมัติ และ route ที่เพิ่ม/ลบบัญชีเรียก invalidate()
+    นอกจากนี้ยังเก็บ index ของ LineAccount ทั้งหมดและลูกค้า -> OA ที่ลูกค้าทักเข้ามา
+    เพื่อให้การส่งข้อความเลือก OA ได้โดยไม่ต้อง query ทุกครั้ง
+    """
+
+    def __init__(self):
+        self.pool_size = 20
+        self.timeout = RequestsHttpClient.DEFAULT_TIMEOUT
+        self.index_ttl = 60
+        self.customer_ttl = 10
+        self.max_customers = 50000
+        self._session = None
+        self._clients = {}
+        self._accounts = None
+        self._accounts_loaded_at = 0
+        self._customer_accounts = OrderedDict()
+
+    def init_app(self, app):
+        self.pool_size = app.config["LINE_HTTP_POOL_SIZE"]
+        self.timeout = app.config["LINE_HTTP_TIMEOUT"]
+        self.index_ttl = app.config["LINE_ACCOUNT_INDEX_TTL"]
+        self.max_customers = app.config["LINE_CUSTOMER_INDEX_MAX_ENTRIES"]
+        customer_ttl = app.config["LINE_CUSTOMER_INDEX_TTL"]
+        if customer_ttl in (None, ""):
+            # worker เดียวเห็นข้อความขาเข้าทุกข้อความ (remember_customer) index จึงไม่หมดอายุ
+            customer_ttl = 10 if app.config.get("SOCKETIO_MESSAGE_QUEUE") else None
+        self.customer_ttl = None if customer_ttl is None else float(customer_ttl)
+
+    @property
+    def session(self):
+        if self._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._session = session
+        return self._session
+
+    def _clients_for(self, acc):
+        clients = self._clients.get(acc.id)
+        if clients is None or clients.token != acc.channel_access_token or clients.secret != acc.channel_secret:
+            # LineBotApi สร้างเมื่อถูกเรียกใช้ครั้งแรก การตรวจลายเซ็น webhook ใช้แค่ SignatureValidator
+            clients = _AccountClients(acc.channel_access_token, acc.channel_secret, None,
+                                      SignatureValidator(acc.channel_secret))
+            self._clients[acc.id] = clients
+        return clients
+
+    def get_api(self, acc):
+        clients = self._clients_for(acc)
+        if clients.api is None:
+            clients.api = LineBotApi(clients.token, timeout=self.timeout,
+                                     http_client=partial(PooledHttpClient, self.session))
+        return clients.api
+
+    def get_validator(self, acc):
+        return self._clients_for(acc).validator
+
+    def _account_index(self):
+        # worker อื่นอาจแก้บัญชีโดยที่ process นี้ไม่รู้ จึงโหลดใหม่เมื่อครบ index_ttl
+        if self._accounts is None or time.monotonic() - self._accounts_loaded_at > self.index_ttl:
+            from app.models import LineAccount
+            self._accounts = {
+                acc.id: AccountRef(acc.id, acc.name, acc.channel_id, acc.channel_secret, acc.channel_access_token)
+                for acc in LineAccount.query.order_by(LineAccount.id).all()
+            }
+            self._accounts_loaded_at = time.monotonic()
+        return self._accounts
+
+    def accounts(self):
+        return list(self._account_index().values())
+
+    def account(self, line_account_id):
+        return self._account_index().get(line_account_id)
+
+    def default_account(self):
+        accounts = self._account_index()
+        return accounts[min(accounts)] if accounts else None
+
+    def remember_customer(self, user_id, line_account_id):
+        # เรียกหลัง commit แล้วเท่านั้น ไม่เช่นนั้น index อาจชี้ OA ที่ถูก rollback ไป
+        self._customer_accounts[user_id] = (line_account_id, time.monotonic())
+        self._customer_accounts.move_to_end(user_id)
+        while len(self._customer_accounts) > self.max_customers:
+            self._customer_accounts.popitem(last=False)
+
+    def account_for_customer(self, user_id):
+        """OA ที่ลูกค้าคนนี้ทักเข้ามาล่าสุด (จาก Conversation.line_account_id) หรือบัญชีแรกถ้าไม่รู้"""
+        entry = self._customer_accounts.get(user_id)
+        if entry is not None and (self.customer_ttl is None or time.monotonic() - entry[1] <= self.customer_ttl):
+            line_account_id = entry[0]
+            self._customer_accounts.move_to_end(user_id)
+        else:
+            from app import db
+            from app.models import Conversation
+            line_account_id = db.session.query(Conversation.line_account_id).filter_by(user_id=user_id).scalar()
+            if line_account_id is not None:
+                self.remember_customer(user_id, line_account_id)
+            else:
+                self._customer_accounts.pop(user_id, None)
+        return self.account(line_account_id) or self.default_account()
+
+    def invalidate(self, line_account_id=None):
+        self._accounts = None
+        if line_account_id is None:
+            self._clients.clear()
+            self._customer_accounts.clear()
+        else:
+            self._clients.pop(line_account_id, None)
+            for user_id in [u for u, (a, _) in self._customer_accounts.items() if a == line_account_id]:
+                del self._customer_accounts[user_id]
+
+    def stats(self):
+        pools = []
+        if self._session is not None:
+            adapter = self._session.get_adapter("https://")
+            manager = adapter.poolmanager
+            for key in list(manager.pools.keys()):
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                pools.append({
+                    "host": pool.host,
+                    "num_connections": pool.num_connections,
+                    "num_requests": pool.num_requests,
+                    "idle_connections": pool.pool.qsize() if pool.pool is not None else 0,
+                    "maxsize": pool.pool.maxsize if pool.pool is not None else self.pool_size,
+                })
+        return {
+            "accounts": sorted(self._clients),
+            "indexed_accounts": sorted(self._accounts or ()),
+            "indexed_customers": len(self._customer_accounts),
+            "pool_size": self.pool_size,
+            "pools": pools,
+        }
+
+
+line_clients = LineClientRegistry()
@@ -0,0 +1,101 @@
+import logging
+import time
+from collections import OrderedDict, namedtuple
+
+import eventlet
+
+logger = logging.getLogger(__name__)
+
+CachedProfile = namedtuple("CachedProfile", ["display_name", "picture_url"])
+
+
+class _Entry:
+    __slots__ = ("profile", "fetched_at", "synced_profile", "user_id")
+
+    def __init__(self, profile, fetched_at):
+        self.profile = profile
+        self.fetched_at = fetched_at
+        self.synced_profile = None  # โปรไฟล์ที่บันทึกลง User แล้ว
+        self.user_id = None
+
+
+class ProfileCache:
+    """แคชโปรไฟล์ LINE ต่อ (line_account_id, line_user_id) แบบ LRU มี TTL
+
+    เมื่อข้อมูลเกิน TTL จะคืนค่าเดิมไปก่อนแล้ว refresh เบื้องหลัง จึงไม่ต้องรอ get_profile ทุกข้อความ
+    """
+
+    def __init__(self, ttl=3600, max_entries=5000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._refreshing = set()
+
+    def init_app(self, app):
+        self.ttl = app.config["PROFILE_CACHE_TTL"]
+        self.max_entries = app.config["PROFILE_CACHE_MAX_ENTRIES"]
+
+    def get(self, line_account_id, line_user_id, fetch):
+        """คืน CachedProfile; fetch() คือฟังก์ชันเรียก LINE get_profile เมื่อไม่มีในแคช"""
+        key = (line_account_id, line_user_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            profile = self._to_cached(fetch())
+            self._store(key, profile)
+            return profile
+        self._entries.move_to_end(key)
+        if time.monotonic() - entry.fetched_at > self.ttl and key not in self._refreshing:
+            self._refreshing.add(key)
+            eventlet.spawn_n(self._refresh, key, fetch)
+        return entry.profile
+
+    def synced_user_id(self, line_account_id, line_user_id, profile):
+        # ถ้าโปรไฟล์ไม่เปลี่ยนจากที่บันทึกลง User ครั้งก่อน ให้ใช้ user_id เดิมได้เลย
+        entry = self._entries.get((line_account_id, line_user_id))
+        if entry is not None and entry.synced_profile == profile:
+            return entry.user_id
+        return None
+
+    def mark_synced(self, line_account_id, line_user_id, profile, user_id):
+        entry = self._entries.get((line_account_id, line_user_id))
+        if entry is not None:
+            entry.synced_profile = profile
+            entry.user_id = user_id
+
+    def invalidate(self, line_account_id=None):
+        if line_account_id is None:
+            self._entries.clear()
+            return
+        for key in [k for k in self._entries if k[0] == line_account_id]:
+            del self._entries[key]
+
+    def _refresh(self, key, fetch):
+        try:
+            profile = self._to_cached(fetch())
+        except Exception:
+            logger.exception("Failed to refresh LINE profile %s", key)
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.fetched_at = time.monotonic()  # ลองใหม่หลังครบ TTL อีกรอบ
+        else:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.profile = profile
+                entry.fetched_at = time.monotonic()
+            else:
+                self._store(key, profile)
+        finally:
+            self._refreshing.discard(key)
+
+    def _store(self, key, profile):
+        self._entries[key] = _Entry(profile, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    @staticmethod
+    def _to_cached(profile):
+        return CachedProfile(profile.display_name, getattr(profile, "picture_url", None))
+
+
+profile_cache = ProfileCache()
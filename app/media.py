@@ -0,0 +1,213 @@
+import hashlib
+import logging
+import os
+import tempfile
+
+import eventlet
+from eventlet import tpool
+from eventlet.queue import LightQueue
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # ไม่มี Pillow ก็ยังใช้งานได้ แค่แสดงรูปขนาดเต็มแทน thumbnail
+    Image = None
+
+from app.storage import media_storage
+
+logger = logging.getLogger(__name__)
+
+# รูปย่อเก็บใน storage ข้างไฟล์ต้นฉบับ: <ชื่อไฟล์>.<kind>.jpg
+VARIANTS = {
+    "thumb": 480,     # แสดงใน bubble ของแชท
+    "preview": 240,   # preview_image_url ของ ImageSendMessage (LINE จำกัด 1 MB)
+}
+
+# ตรวจชนิดไฟล์จาก magic bytes ไม่เชื่อนามสกุลหรือ header อย่างเดียว
+SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png", "png"),
+    (b"GIF87a", "image/gif", "gif"),
+    (b"GIF89a", "image/gif", "gif"),
+]
+EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/gif": "gif",
+    "image/webp": "webp",
+}
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+def sniff_content_type(head, declared=None):
+    """คืน (content_type, นามสกุล) จากไบต์แรกของไฟล์ ถ้าไม่รู้จักใช้ content type ที่ LINE ส่งมา"""
+    for magic, content_type, ext in SIGNATURES:
+        if head.startswith(magic):
+            return content_type, ext
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp", "webp"
+    declared = (declared or "").split(";")[0].strip().lower()
+    return declared or "application/octet-stream", EXTENSIONS.get(declared, "bin")
+
+
+def stream_to_temp(chunks, folder, max_bytes):
+    """เขียน chunk ลงไฟล์ชั่วคราวพร้อมคำนวณ sha256 คืน (tmp_path, sha256 hex, size, ไบต์แรก)"""
+    os.makedirs(folder, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    head = b""
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix="incoming-")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if size > max_bytes:
+                    raise MediaTooLarge(f"media exceeds {max_bytes} bytes")
+                if len(head) < 16:
+                    head += chunk[:16 - len(head)]
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest(), size, head
+
+
+def variant_filename(filename, kind):
+    return f"{filename}.{kind}.jpg"
+
+
+def existing_variant(filename, kind):
+    """ชื่อไฟล์รูปย่อถ้าสร้างไว้แล้ว ไม่อย่างนั้นคืนไฟล์ต้นฉบับ"""
+    variant = variant_filename(filename, kind)
+    if media_storage.exists(variant):
+        return variant
+    return filename
+
+
+def _render_variants(src_path, folder):
+    rendered = {}
+    with Image.open(src_path) as im:
+        im = ImageOps.exif_transpose(im)
+        if im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        for kind, size in VARIANTS.items():
+            copy = im.copy()
+            copy.thumbnail((size, size))
+            fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=f"{kind}-", suffix=".jpg")
+            with os.fdopen(fd, "wb") as out:
+                copy.save(out, "JPEG", quality=80, optimize=True, progressive=True)
+            rendered[kind] = tmp_path
+    return rendered
+
+
+def make_variants(src_path, filename, folder):
+    """สร้าง thumbnail และ preview ของรูปแล้วเก็บลง storage
+
+    ทำใน thread pool เพราะ Pillow ใช้ CPU และจะบล็อก eventlet hub
+    """
+    if Image is None:
+        return False
+    try:
+        rendered = tpool.execute(_render_variants, src_path, folder)
+    except Exception:
+        logger.exception("Failed to create image variants for %s", filename)
+        return False
+    for kind, tmp_path in rendered.items():
+        media_storage.put_file(variant_filename(filename, kind), tmp_path, "image/jpeg")
+    return True
+
+
+def ingest_stream(chunks, max_bytes, declared_type=None):
+    """รับไฟล์สื่อเข้า storage โดยตั้งชื่อตาม sha256 ของเนื้อหา ไฟล์ซ้ำจะใช้ของเดิม
+
+    คืน (filename, content_type, size)
+    """
+    tmp_folder = media_storage.tmp_folder
+    tmp_path, sha256, size, head = stream_to_temp(chunks, tmp_folder, max_bytes)
+    try:
+        content_type, ext = sniff_content_type(head, declared_type)
+        filename = f"{sha256}.{ext}"
+        if not media_storage.exists(filename):
+            if content_type.startswith("image/"):
+                make_variants(tmp_path, filename, tmp_folder)
+            media_storage.put_file(filename, tmp_path, content_type)
+        return filename, content_type, size
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class MediaDownloader:
+    """ดาวน์โหลดรูปที่ลูกค้าส่งมาจาก LINE content API เบื้องหลัง
+
+    handler ของ webhook บันทึกข้อความไว้ก่อน (media_url เป็น placeholder) แล้ว enqueue งานมาที่นี่
+    งานค้างจะถูกดึงกลับมาจากฐานข้อมูลตอน start จึงไม่หายถ้า process ตาย
+    """
+
+    def __init__(self):
+        self._queue = LightQueue()
+        self._app = None
+        self._pool = None
+        self._dispatcher = None
+        self._on_done = None
+        self._on_error = None
+
+    def start(self, app, on_done, on_error, pending):
+        if self._dispatcher is not None:
+            return
+        self._app = app
+        self._on_done = on_done
+        self._on_error = on_error
+        self._pool = eventlet.GreenPool(app.config["MEDIA_DOWNLOAD_WORKERS"])
+        self._dispatcher = eventlet.spawn(self._dispatch_forever)
+        with app.app_context():
+            for item in pending():
+                self.enqueue(*item)
+
+    def enqueue(self, message_id, line_account_id, line_message_id, attempt=1, delay=0):
+        item = (message_id, line_account_id, line_message_id, attempt)
+        if delay:
+            eventlet.spawn_after(delay, self._queue.put, item)
+        else:
+            self._queue.put(item)
+
+    def _dispatch_forever(self):
+        while True:
+            item = self._queue.get()
+            self._pool.spawn_n(self._process, *item)
+
+    def _process(self, message_id, line_account_id, line_message_id, attempt):
+        from app.line_clients import line_clients
+
+        config = self._app.config
+        try:
+            with self._app.test_request_context():
+                acc = line_clients.account(line_account_id)
+                if acc is None:
+                    raise LookupError(f"LINE account {line_account_id} no longer exists")
+                content = line_clients.get_api(acc).get_message_content(line_message_id)
+                filename, content_type, size = ingest_stream(
+                    content.iter_content(chunk_size=config["MEDIA_CHUNK_SIZE"]),
+                    config["MEDIA_MAX_BYTES"],
+                    declared_type=content.content_type,
+                )
+                self._on_done(message_id, filename, content_type, size)
+        except Exception as e:
+            if not isinstance(e, (MediaTooLarge, LookupError)) and attempt < config["MEDIA_MAX_ATTEMPTS"]:
+                logger.warning("Media download for message %s failed (attempt %d), retrying: %s", message_id, attempt, e)
+                self.enqueue(message_id, line_account_id, line_message_id, attempt + 1, delay=2 ** attempt)
+                return
+            logger.exception("Failed to download media for message %s", message_id)
+            try:
+                with self._app.test_request_context():
+                    self._on_error(message_id, str(e))
+            except Exception:
+                logger.exception("Failed to mark media of message %s as failed", message_id)
+
+
+media_downloader = MediaDownloader()
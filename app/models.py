@@ -7,14 +7,15 @@ from app import login_manager, db
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    from app.user_cache import user_cache
+    return user_cache.load(int(user_id))
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=True)
     password_hash = db.Column(db.String(128), nullable=True)
-    role = db.Column(db.String(20), default="staff")
+    role = db.Column(db.String(20), default="staff", index=True)  # ดึงรายชื่อ staff ทุก event ของ webhook
     line_user_id = db.Column(db.String(64), unique=True, nullable=True)
     picture_url = db.Column(db.String(255), nullable=True)
 
@@ -51,6 +52,24 @@ class Group(db.Model):
         return f"<Group {self.name}>"
 
 class Message(db.Model):
+    __table_args__ = (
+        # ดึงประวัติแชทแบบแบ่งหน้าด้วย cursor (timestamp, id)
+        db.Index("ix_message_user_id_timestamp_id", "user_id", "timestamp", "id"),
+        db.Index("ix_message_recipient_id_timestamp_id", "recipient_id", "timestamp", "id"),
+        # คิวส่งข้อความที่ค้างอยู่ตอน start (เล็กมากเพราะมีแต่แถวที่ยัง pending)
+        db.Index(
+            "ix_message_delivery_pending", "id",
+            sqlite_where=db.text("delivery_status = 'pending'"),
+            postgresql_where=db.text("delivery_status = 'pending'"),
+        ),
+        # รูปขาเข้าที่ค้างดาวน์โหลดตอน start (ต้องตรงกับ PENDING_MEDIA_PREFIX)
+        db.Index(
+            "ix_message_media_pending", "id",
+            sqlite_where=db.text("media_url LIKE 'line-content:%'"),
+            postgresql_where=db.text("media_url LIKE 'line-content:%'"),
+        ),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.Text, nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # ✅ เพิ่ม index
@@ -58,20 +77,82 @@ class Message(db.Model):
     media_url = db.Column(db.String(255), nullable=True)
     sticker_id = db.Column(db.String(50), nullable=True)
     package_id = db.Column(db.String(50), nullable=True)
-    is_read = db.Column(db.Boolean, nullable=False, default=False, server_default=db.text('0'))
 
+    # สถานะการส่งออกไป LINE ของข้อความขาออก: pending / sent / failed (ขาเข้าและ system เป็น None)
+    delivery_status = db.Column(db.String(20), nullable=True)
+    delivery_attempts = db.Column(db.Integer, nullable=False, default=0, server_default=db.text('0'))
+    delivery_error = db.Column(db.String(255), nullable=True)
+
+    # ข้อความขาเข้าจากลูกค้าเก็บแถวเดียว: user_id = ลูกค้า, recipient_id = None
+    # ข้อความขาออก/system: user_id = staff ผู้ส่ง, recipient_id = ลูกค้า
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True, index=True)          # ✅ เพิ่ม index
-    recipient_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True, index=True)    # ✅ เพิ่ม index
+    recipient_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True)  # ใช้ ix_message_recipient_id_timestamp_id
     line_account_id = db.Column(db.Integer, db.ForeignKey("line_account.id"), nullable=True, index=True)  # ✅ เพิ่ม index
 
-    author = db.relationship("User", foreign_keys=[user_id], backref=db.backref('sent_messages', lazy='joined'))
-    recipient = db.relationship("User", foreign_keys=[recipient_id], backref=db.backref('received_messages', lazy='joined'))
+    # id จาก LINE ของข้อความขาเข้า (unique) กันบันทึกซ้ำเมื่อ LINE ส่ง webhook เดิมมาอีกครั้ง
+    line_message_id = db.Column(db.String(64), nullable=True, unique=True, index=True)
+    webhook_event_id = db.Column(db.String(64), nullable=True, unique=True, index=True)
+
+    # ประวัติข้อความของ User ต้องดึงผ่าน query เสมอ (lazy='dynamic') ไม่ JOIN มาพร้อมทุกครั้งที่โหลด User
+    author = db.relationship("User", foreign_keys=[user_id], backref=db.backref('sent_messages', lazy='dynamic'))
+    recipient = db.relationship("User", foreign_keys=[recipient_id], backref=db.backref('received_messages', lazy='dynamic'))
     line_account = db.relationship("LineAccount", backref="messages")
 
+    # รูปขาเข้าที่ media_downloader ยังดาวน์โหลดไม่เสร็จ: media_url = "line-content:<LINE message id>"
+    PENDING_MEDIA_PREFIX = "line-content:"
+
+    @property
+    def media_pending(self):
+        return bool(self.media_url) and self.media_url.startswith(self.PENDING_MEDIA_PREFIX)
+
     def __repr__(self):
         return f"<Message {self.id} {self.message_type}>"
 
 
+class ReadState(db.Model):
+    """ตำแหน่งข้อความล่าสุดที่ staff แต่ละคนอ่านแล้วในห้องแชทของลูกค้าแต่ละคน"""
+    __tablename__ = "read_state"
+    __table_args__ = (
+        db.UniqueConstraint("staff_id", "user_id"),
+        # get_unread_counts / increment_unread ค้นตามลูกค้า อ่านจาก index ได้โดยไม่ต้องแตะตาราง
+        db.Index("ix_read_state_user_id_staff_id_unread_count", "user_id", "staff_id", "unread_count"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    staff_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)  # ลูกค้า (guest)
+    last_read_message_id = db.Column(db.Integer, nullable=False, default=0, server_default=db.text('0'))
+    unread_count = db.Column(db.Integer, nullable=False, default=0, server_default=db.text('0'))
+
+    def __repr__(self):
+        return f"<ReadState staff={self.staff_id} user={self.user_id} last_read={self.last_read_message_id}>"
+
+
+class Conversation(db.Model):
+    """สรุปห้องแชทของลูกค้าแต่ละคน (ข้อความล่าสุด / OA) สำหรับแสดงรายชื่อด้านซ้ายด้วย query เดียว"""
+    __table_args__ = (
+        # ตรงกับ ORDER BY last_message_at DESC NULLS LAST, id DESC ของ conversation_page_query
+        db.Index(
+            "ix_conversation_last_message_at_id", "last_message_at", "id",
+            postgresql_ops={"last_message_at": "DESC NULLS LAST", "id": "DESC"},
+        ),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, unique=True)  # ลูกค้า (guest)
+    line_account_id = db.Column(db.Integer, db.ForeignKey("line_account.id"), nullable=True)  # OA ที่ลูกค้าทักเข้ามาล่าสุด
+    last_message_id = db.Column(db.Integer, db.ForeignKey("message.id"), nullable=True)
+    last_message_at = db.Column(db.DateTime, nullable=True)
+    last_message_type = db.Column(db.String(20), nullable=True)
+    last_message_preview = db.Column(db.String(255), nullable=True)
+
+    user = db.relationship("User", foreign_keys=[user_id])
+    last_message = db.relationship("Message", foreign_keys=[last_message_id])
+
+    def __repr__(self):
+        return f"<Conversation user={self.user_id} last_message={self.last_message_id}>"
+
+
 class QuickReply(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False, server_default='')
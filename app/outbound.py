@@ -0,0 +1,108 @@
+import logging
+import time
+
+import eventlet
+from eventlet.queue import LightQueue
+
+logger = logging.getLogger(__name__)
+
+
+class RetryLater(Exception):
+    """ให้ deliver() raise เมื่อการส่งล้มเหลวแบบชั่วคราวและควรลองใหม่"""
+
+
+class TokenBucket:
+    """จำกัดอัตราการส่งต่อ LINE OA (rate ข้อความ/วินาที, ส่งติดกันได้ไม่เกิน burst)"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            eventlet.sleep((1 - self.tokens) / self.rate)
+
+
+class OutboundQueue:
+    """คิวส่งข้อความออกไป LINE เบื้องหลัง พร้อม retry แบบ exponential backoff และ rate limit ต่อบัญชี
+
+    สถานะจริงของข้อความอยู่ในตาราง message (delivery_status) คิวนี้เก็บแค่ id จึงกู้คืนได้ตอน start
+    """
+
+    def __init__(self):
+        self._queue = LightQueue()
+        self._buckets = {}
+        self._app = None
+        self._pool = None
+        self._dispatcher = None
+        self._deliver = None
+        self._on_give_up = None
+
+    def start(self, app, deliver, on_give_up, pending):
+        if self._dispatcher is not None:
+            return
+        self._app = app
+        self._deliver = deliver
+        self._on_give_up = on_give_up
+        self._pool = eventlet.GreenPool(app.config['OUTBOUND_WORKERS'])
+        self._dispatcher = eventlet.spawn(self._dispatch_forever)
+        with app.app_context():
+            for message_id, line_account_id in pending():
+                self.enqueue(message_id, line_account_id)
+
+    def enqueue(self, message_id, line_account_id, attempt=1, delay=0):
+        item = (message_id, line_account_id, attempt)
+        if delay:
+            eventlet.spawn_after(delay, self._queue.put, item)
+        else:
+            self._queue.put(item)
+
+    def _bucket(self, line_account_id):
+        bucket = self._buckets.get(line_account_id)
+        if bucket is None:
+            config = self._app.config
+            bucket = TokenBucket(config['OUTBOUND_RATE_PER_SECOND'], config['OUTBOUND_RATE_BURST'])
+            self._buckets[line_account_id] = bucket
+        return bucket
+
+    def _dispatch_forever(self):
+        while True:
+            item = self._queue.get()
+            self._pool.spawn_n(self._process, *item)
+
+    def _process(self, message_id, line_account_id, attempt):
+        config = self._app.config
+        self._bucket(line_account_id).acquire()
+        try:
+            # ต้องมี request context เพราะ url_for ใช้สร้าง URL รูป และ template ของ Socket.IO
+            with self._app.test_request_context():
+                self._deliver(message_id, attempt)
+        except RetryLater as e:
+            if attempt >= config['OUTBOUND_MAX_ATTEMPTS']:
+                self._give_up(message_id, str(e))
+            else:
+                delay = min(config['OUTBOUND_MAX_BACKOFF'], config['OUTBOUND_BASE_BACKOFF'] * 2 ** (attempt - 1))
+                logger.warning("Delivery of message %s failed (attempt %d), retrying in %.1fs: %s",
+                               message_id, attempt, delay, e)
+                self.enqueue(message_id, line_account_id, attempt + 1, delay=delay)
+        except Exception as e:
+            logger.exception("Unexpected error delivering message %s", message_id)
+            self._give_up(message_id, str(e))
+
+    def _give_up(self, message_id, error):
+        try:
+            with self._app.test_request_context():
+                self._on_give_up(message_id, error)
+        except Exception:
+            logger.exception("Failed to mark message %s as failed", message_id)
+
+
+outbound_queue = OutboundQueue()
@@ -0,0 +1,137 @@
+import time
+from collections import defaultdict, namedtuple
+
+IndexedReply = namedtuple("IndexedReply", ["id", "name", "text", "line_account_id", "key"])
+
+
+def normalize(value):
+    return " ".join((value or "").casefold().split())
+
+
+def trigrams(value):
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+def match_rank(key, query):
+    """ยิ่งน้อยยิ่งตรง: ตรงทั้งชื่อ < ขึ้นต้นด้วย < ขึ้นต้นคำใดคำหนึ่ง < อยู่กลางคำ; None = ไม่ตรง"""
+    if key == query:
+        return 0
+    if key.startswith(query):
+        return 1
+    pos = key.find(query)
+    if pos < 0:
+        return None
+    if key[pos - 1] == " ":
+        return 2
+    return 3
+
+
+class _Scope:
+    __slots__ = ("replies", "grams")
+
+    def __init__(self):
+        self.replies = {}
+        self.grams = defaultdict(set)
+
+    def add(self, reply):
+        self.replies[reply.id] = reply
+        for gram in trigrams(reply.key):
+            self.grams[gram].add(reply.id)
+
+    def remove(self, reply_id):
+        reply = self.replies.pop(reply_id, None)
+        if reply is None:
+            return
+        for gram in trigrams(reply.key):
+            ids = self.grams.get(gram)
+            if ids is not None:
+                ids.discard(reply_id)
+                if not ids:
+                    del self.grams[gram]
+
+    def candidates(self, query):
+        # คำค้นสั้นกว่า 3 ตัวไม่มี trigram ให้ใช้ ไล่ทั้ง scope (scope หนึ่งมีไม่กี่ร้อยรายการ)
+        if len(query) < 3:
+            return self.replies.values()
+        ids = None
+        for gram in sorted(trigrams(query), key=lambda g: len(self.grams.get(g, ()))):
+            posting = self.grams.get(gram)
+            if not posting:
+                return []
+            ids = set(posting) if ids is None else ids & posting
+            if not ids:
+                return []
+        return [self.replies[i] for i in ids]
+
+
+class QuickReplyIndex:
+    """index ของ QuickReply ในหน่วยความจำ แยกตาม scope (None = global, หรือ line_account_id)
+
+    route ที่เพิ่ม/แก้/ลบ quick reply เรียก upsert()/remove() ส่วน worker อื่นจะโหลดใหม่เมื่อครบ ttl
+    """
+
+    def __init__(self, ttl=300, limit=10):
+        self.ttl = ttl
+        self.limit = limit
+        self._scopes = None
+        self._loaded_at = 0
+        self.version = 0
+
+    def init_app(self, app):
+        self.ttl = app.config["QUICK_REPLY_INDEX_TTL"]
+        self.limit = app.config["QUICK_REPLY_RESULTS_LIMIT"]
+
+    def _index(self):
+        if self._scopes is None or time.monotonic() - self._loaded_at > self.ttl:
+            from app.models import QuickReply
+            scopes = defaultdict(_Scope)
+            for qr in QuickReply.query.all():
+                scopes[qr.line_account_id].add(self._entry(qr))
+            self._scopes = scopes
+            self._loaded_at = time.monotonic()
+            self.version += 1
+        return self._scopes
+
+    @staticmethod
+    def _entry(qr):
+        return IndexedReply(qr.id, qr.name, qr.text, qr.line_account_id, normalize(qr.name))
+
+    def invalidate(self):
+        self._scopes = None
+
+    def upsert(self, qr):
+        scopes = self._index()
+        for scope in scopes.values():
+            scope.remove(qr.id)
+        scopes[qr.line_account_id].add(self._entry(qr))
+        self.version += 1
+
+    def remove(self, qr_id):
+        for scope in self._index().values():
+            scope.remove(qr_id)
+        self.version += 1
+
+    def _scopes_for(self, line_account_id):
+        scopes = self._index()
+        keys = [None] if line_account_id is None else [None, line_account_id]
+        return [scopes[k] for k in keys if k in scopes]
+
+    def search(self, query, line_account_id=None, limit=None):
+        query = normalize(query)
+        if not query:
+            return []
+        ranked = []
+        for scope in self._scopes_for(line_account_id):
+            for reply in scope.candidates(query):
+                rank = match_rank(reply.key, query)
+                if rank is not None:
+                    ranked.append((rank, len(reply.key), reply.key, reply.id, reply))
+        ranked.sort(key=lambda item: item[:4])
+        return [item[-1] for item in ranked[:limit or self.limit]]
+
+    def scope_list(self, line_account_id=None):
+        replies = [r for scope in self._scopes_for(line_account_id) for r in scope.replies.values()]
+        return sorted(replies, key=lambda r: (r.key, r.id))
+
+
+quick_reply_index = QuickReplyIndex()
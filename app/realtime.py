@@ -0,0 +1,80 @@
+import time
+from collections import namedtuple
+
+from flask import request
+from flask_login import current_user
+from flask_socketio import join_room
+from app import socketio
+
+STAFF_ROLES = ('admin', 'staff', 'owner')
+
+StaffMember = namedtuple("StaffMember", ["id", "username", "role"])
+
+
+def staff_room(staff_id):
+    # ห้อง Socket.IO ส่วนตัวของ staff แต่ละคน update_chat จะส่งเข้าห้องนี้เท่านั้น
+    return f"staff:{staff_id}"
+
+
+class StaffRoster:
+    """รายชื่อ staff ที่ใช้วน emit/เพิ่มตัวนับ unread แคชไว้ต่อ process และติดตามว่าใครต่อ Socket.IO อยู่
+
+    route จัดการผู้ใช้เรียก invalidate() ส่วน worker อื่นจะโหลดใหม่เมื่อครบ ttl
+    การติดตามคนออนไลน์ใช้ได้เฉพาะ process เดียว ถ้าตั้ง SOCKETIO_MESSAGE_QUEUE (หลาย worker)
+    staff อาจต่ออยู่กับ worker อื่น online() จึงคืนทุกคน
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.track_presence = True
+        self._members = None
+        self._loaded_at = 0
+        self._sessions = {}  # sid -> staff id
+
+    def init_app(self, app):
+        self.ttl = app.config["STAFF_ROSTER_TTL"]
+        self.track_presence = not app.config.get("SOCKETIO_MESSAGE_QUEUE")
+
+    def members(self):
+        if self._members is None or time.monotonic() - self._loaded_at > self.ttl:
+            from app.models import User
+            rows = User.query.filter(User.role.in_(STAFF_ROLES)).order_by(User.id).all()
+            self._members = [StaffMember(u.id, u.username, u.role) for u in rows]
+            self._loaded_at = time.monotonic()
+        return self._members
+
+    def online(self):
+        members = self.members()
+        if not self.track_presence:
+            return members
+        connected = set(self._sessions.values())
+        return [m for m in members if m.id in connected]
+
+    def invalidate(self):
+        self._members = None
+
+    def connected(self, sid, staff_id):
+        self._sessions[sid] = staff_id
+
+    def disconnected(self, sid):
+        self._sessions.pop(sid, None)
+
+
+staff_roster = StaffRoster()
+
+
+def init_app(app):
+    staff_roster.init_app(app)
+
+
+@socketio.on('connect')
+def handle_connect(auth=None):
+    if not current_user.is_authenticated or current_user.role not in STAFF_ROLES:
+        return False
+    join_room(staff_room(current_user.id))
+    staff_roster.connected(request.sid, current_user.id)
+
+
+@socketio.on('disconnect')
+def handle_disconnect(reason=None):
+    staff_roster.disconnected(request.sid)
@@ -1,20 +1,32 @@
 import os
 import datetime
+import json
 import re
+import uuid
+import requests
+import eventlet
 from functools import wraps
 from flask import (
     Blueprint, render_template, redirect, url_for,
     flash, request, current_app, send_from_directory,
-    render_template_string, jsonify
+    jsonify, abort, Response
 )
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash
-from werkzeug.utils import secure_filename
-from sqlalchemy import or_, and_, distinct
-from app import db, socketio
-from app.models import User, LineAccount, Group, Message, QuickReply
-from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from sqlalchemy import or_, and_, case, distinct, func, insert, literal, select, union_all
+from app import db, socketio, webhook_queue
+from app.models import User, LineAccount, Group, Message, QuickReply, ReadState, Conversation
+from app.line_profiles import profile_cache
+from app.line_clients import line_clients
+from app.realtime import staff_room, staff_roster
+from app.outbound import outbound_queue, RetryLater
+from app.media import media_downloader, ingest_stream, existing_variant, MediaTooLarge
+from app.storage import media_storage, MediaRangeError
+from app.quick_replies import quick_reply_index
+from app.search import search_messages, highlight
+from app.unread import unread_reconciler
+from app.user_cache import user_cache
+from linebot.exceptions import LineBotApiError
 from linebot.models import (
     MessageEvent, TextMessage, StickerMessage, ImageMessage,
     TextSendMessage, ImageSendMessage, StickerSendMessage
@@ -36,17 +48,17 @@ USER_LIST_ITEM_HTML = """
     {% endif %}
     <div class="user-list-info ms-2">
       <div class="user-list-header">
-        <div class="fw-semibold text-truncate">{{ data.user_info.username }}</div>
-        {% if data.last_message %}<div class="small text-muted flex-shrink-0 ps-2">{{ data.last_message.timestamp.strftime('%H:%M') }}</div>{% endif %}
+        <div class="fw-semibold text-truncate" id="user-list-name-{{ data.user_info.id }}">{{ data.user_info.username }}</div>
+        {% if data.conversation and data.conversation.last_message_at %}<div class="small text-muted flex-shrink-0 ps-2">{{ data.conversation.last_message_at.strftime('%H:%M') }}</div>{% endif %}
       </div>
       <div class="user-list-body">
         <div class="small text-muted text-truncate">
-          {% if data.last_message %}
-            {% if data.last_message.message_type == 'text' %}
-              {{ data.last_message.text }}
-            {% elif data.last_message.message_type == 'image' %}
+          {% if data.conversation and data.conversation.last_message_id %}
+            {% if data.conversation.last_message_type == 'text' %}
+              {{ data.conversation.last_message_preview }}
+            {% elif data.conversation.last_message_type == 'image' %}
               <i class="bi bi-image-fill"></i> รูปภาพ
-            {% elif data.last_message.message_type == 'sticker' %}
+            {% elif data.conversation.last_message_type == 'sticker' %}
               <i class="bi bi-sticky-fill"></i> สติ๊กเกอร์
             {% endif %}
           {% else %}
@@ -61,23 +73,125 @@ USER_LIST_ITEM_HTML = """
 """
 
 MESSAGE_BUBBLE_HTML = """
-<div class="mb-3 d-flex flex-column {% if msg.user_id == current_user.id %}msg-right{% else %}msg-left{% endif %}">
+<div class="mb-3 d-flex flex-column {% if msg.recipient_id %}msg-right{% else %}msg-left{% endif %}">
     {% if msg.message_type == 'text' %}
-        <div class="{% if msg.user_id == current_user.id %}bubble-right{% else %}bubble-left{% endif %}">
+        <div class="{% if msg.recipient_id %}bubble-right{% else %}bubble-left{% endif %}">
         {{ msg.text | safe }}
         </div>
     {% elif msg.message_type == 'image' %}
-        <img src="{{ url_for('static', filename='uploads/' + msg.media_url) }}" class="chat-image" data-bs-toggle="modal" data-bs-target="#imageModal" onclick="document.getElementById('modalImage').src = this.src">
+        {% if msg.media_pending %}
+        <div class="bubble-left text-muted" id="msg-media-{{ msg.id }}"><i class="bi bi-hourglass-split"></i> กำลังโหลดรูปภาพ...</div>
+        {% elif msg.media_url %}
+        <img src="{{ media_url_for(msg.media_url, 'thumb') }}" data-full-src="{{ media_url_for(msg.media_url) }}" loading="lazy" class="chat-image" data-bs-toggle="modal" data-bs-target="#imageModal" onclick="document.getElementById('modalImage').src = this.dataset.fullSrc">
+        {% else %}
+        <div class="bubble-left text-muted"><i class="bi bi-image"></i> {{ msg.text or 'ไม่มีรูปภาพ' }}</div>
+        {% endif %}
     {% elif msg.message_type == 'sticker' %}
         <img src="https://stickershop.line-scdn.net/stickershop/v1/sticker/{{ msg.sticker_id }}/android/sticker.png" class="chat-sticker">
     {% elif msg.message_type == 'system' %}
         <div class="bubble-left bg-warning text-dark" style="font-size:0.85em;">{{ msg.text }}</div>
-        <img src="https://stickershop.line-scdn.net/stickershop/v1/sticker/{{ msg.sticker_id }}/android/sticker.png" class="chat-sticker">
     {% endif %}
-    <div class="msg-meta">{{ msg.timestamp.strftime('%Y-%m-%d %H:%M') }}</div>
+    <div class="msg-meta">{{ msg.timestamp.strftime('%Y-%m-%d %H:%M') }}
+      {% if msg.delivery_status %}<span class="msg-status ms-1" id="msg-status-{{ msg.id }}">{% if msg.delivery_status == 'pending' %}<i class="bi bi-clock" title="กำลังส่ง"></i>{% elif msg.delivery_status == 'failed' %}<i class="bi bi-exclamation-circle text-danger" title="ส่งไม่สำเร็จ: {{ msg.delivery_error or '' }}"></i>{% else %}<i class="bi bi-check2" title="ส่งแล้ว"></i>{% endif %}</span>{% endif %}
+    </div>
 </div>
 """
 
+# Jinja template ที่ compile แล้ว (compile ครั้งเดียวตอน register blueprint ไม่ parse ใหม่ทุกครั้งที่ emit)
+_compiled_templates = {}
+
+@bp.app_template_global()
+def media_url_for(filename, kind=None):
+    # kind = 'thumb' / 'preview' ใช้รูปย่อถ้ามี ไม่มีก็ใช้ไฟล์ต้นฉบับ
+    if kind:
+        filename = existing_variant(filename, kind)
+    return media_storage.url(filename)
+
+def absolute_media_url(filename, kind=None):
+    url = media_url_for(filename, kind)
+    if url.startswith(('http://', 'https://')):
+        return url
+    return f"{public_base_url()}{url}"
+
+@bp.record_once
+def compile_realtime_templates(state):
+    env = state.app.jinja_env
+    _compiled_templates['user_list_item'] = env.from_string(USER_LIST_ITEM_HTML)
+    _compiled_templates['message_bubble'] = env.from_string(MESSAGE_BUBBLE_HTML)
+
+def render_message_bubble(msg):
+    return render_template(_compiled_templates['message_bubble'], msg=msg)
+
+def render_user_list_item(user, conversation, unread_count):
+    data = {'user_info': user, 'conversation': conversation, 'unread_count': unread_count}
+    return render_template(_compiled_templates['user_list_item'], data=data)
+
+# ===================== Realtime payloads =====================
+def serialize_message(msg):
+    return {
+        'id': msg.id,
+        'user_id': msg.user_id,
+        'recipient_id': msg.recipient_id,
+        'message_type': msg.message_type,
+        'text': msg.text,
+        'media_url': media_url_for(msg.media_url) if msg.media_url and not msg.media_pending else None,
+        'thumbnail_url': media_url_for(msg.media_url, 'thumb') if msg.media_url and not msg.media_pending else None,
+        'media_pending': msg.media_pending,
+        'sticker_id': msg.sticker_id,
+        'package_id': msg.package_id,
+        'timestamp': msg.timestamp.isoformat() if msg.timestamp else None,
+        'delivery_status': msg.delivery_status,
+        'delivery_error': msg.delivery_error,
+    }
+
+def serialize_conversation_item(user, conversation):
+    return {
+        'id': user.id,
+        'username': user.username,
+        'picture_url': user.picture_url,
+        'url': url_for('main.chat_all', user_id=user.id),
+        'last_message_at': conversation.last_message_at.isoformat() if conversation.last_message_at else None,
+        'last_message_type': conversation.last_message_type,
+        'last_message_preview': conversation.last_message_preview,
+    }
+
+def chat_update_payloads(user, conversation, messages, staff_members, unread_counts):
+    # ข้อความใหม่ของห้องเดียวกันรวมเป็น event เดียว (เรียงเก่าไปใหม่) คืน [(payload, room), ...]
+    # bubble เหมือนกันทุกคนจึง render ครั้งเดียว; รายการด้านซ้ายต่างกันแค่ตัวนับ unread
+    if current_app.config['REALTIME_PAYLOAD_FORMAT'] == 'json':
+        base = {
+            'user_id': user.id,
+            'conversation': serialize_conversation_item(user, conversation),
+            'messages': [serialize_message(msg) for msg in messages],
+        }
+        return [
+            (dict(base, recipient_id=staff_member.id, unread_count=unread_counts.get(staff_member.id, 0)),
+             staff_room(staff_member.id))
+            for staff_member in staff_members
+        ]
+
+    message_bubble_html = ''.join(render_message_bubble(msg) for msg in messages)
+    list_items = {}
+    payloads = []
+    for staff_member in staff_members:
+        unread_count = unread_counts.get(staff_member.id, 0)
+        if unread_count not in list_items:
+            list_items[unread_count] = render_user_list_item(user, conversation, unread_count)
+        payloads.append(({
+            'user_id': user.id,
+            'recipient_id': staff_member.id,
+            'user_list_item_html': list_items[unread_count],
+            'message_bubble_html': message_bubble_html,
+        }, staff_room(staff_member.id)))
+    return payloads
+
+def emit_chat_update(user, conversation, messages, staff_members, unread_counts):
+    emit_payloads(chat_update_payloads(user, conversation, messages, staff_members, unread_counts))
+
+def emit_payloads(payloads):
+    for payload, room in payloads:
+        socketio.emit('update_chat', payload, to=room)
+
 # ===================== Role-based Access Decorators =====================
 def owner_required(f):
     @wraps(f)
@@ -142,6 +256,7 @@ def change_password():
         else:
             current_user.set_password(new_password)
             db.session.commit()
+            user_cache.invalidate(current_user.id)
             flash("Your password has been updated successfully.", "success")
             return redirect(url_for("main.chat_all"))
 
@@ -169,6 +284,7 @@ def manage_users():
             user.set_password(password)
             db.session.add(user)
             db.session.commit()
+            staff_roster.invalidate()
             flash("User added successfully", "success")
         return redirect(url_for("main.manage_users"))
 
@@ -193,8 +309,12 @@ def delete_user(user_id):
         flash("Admins cannot delete other Admins.", "danger")
         return redirect(url_for('main.manage_users'))
 
+    ReadState.query.filter(or_(ReadState.staff_id == user_to_delete.id, ReadState.user_id == user_to_delete.id)).delete(synchronize_session=False)
+    Conversation.query.filter_by(user_id=user_to_delete.id).delete(synchronize_session=False)
     db.session.delete(user_to_delete)
     db.session.commit()
+    user_cache.invalidate(user_id)
+    staff_roster.invalidate()
     flash(f"User '{user_to_delete.username}' has been deleted.", "success")
     return redirect(url_for("main.manage_users"))
 
@@ -215,6 +335,7 @@ def reset_password_for_user(user_id):
 
     user_to_update.set_password(new_password)
     db.session.commit()
+    user_cache.invalidate(user_id)
     flash(f"Password for '{user_to_update.username}' has been reset.", "success")
     return redirect(url_for("main.manage_users"))
 
@@ -232,6 +353,8 @@ def edit_user_role(user_id):
         return redirect(url_for('main.manage_users'))
     user_to_edit.role = new_role
     db.session.commit()
+    user_cache.invalidate(user_id)
+    staff_roster.invalidate()
     flash(f"Role for '{user_to_edit.username}' updated to '{new_role}'.", "success")
     return redirect(url_for("main.manage_users"))
 
@@ -247,6 +370,7 @@ def manage_line_accounts():
         acc = LineAccount(name=name, channel_id=channel_id, channel_secret=channel_secret, channel_access_token=channel_access_token)
         db.session.add(acc)
         db.session.commit()
+        line_clients.invalidate(acc.id)
         flash("Line account added successfully", "success")
         return redirect(url_for("main.manage_line_accounts"))
     line_accounts = LineAccount.query.all()
@@ -260,9 +384,17 @@ def delete_line_account(acc_id):
     acc = LineAccount.query.get_or_404(acc_id)
     db.session.delete(acc)
     db.session.commit()
+    line_clients.invalidate(acc_id)
+    profile_cache.invalidate(acc_id)
     flash("Line account deleted", "info")
     return redirect(url_for("main.manage_line_accounts"))
 
+@bp.route("/api/line_clients/stats")
+@login_required
+@admin_required
+def api_line_client_stats():
+    return jsonify(line_clients.stats())
+
 # ===================== Manage Groups =====================
 @bp.route("/manage_groups", methods=["GET", "POST"])
 @login_required
@@ -305,6 +437,7 @@ def manage_quick_replies():
             new_qr = QuickReply(name=name, text=text, line_account_id=line_account_id)
             db.session.add(new_qr)
             db.session.commit()
+            quick_reply_index.upsert(new_qr)
             flash("Quick Reply added successfully.", "success")
         return redirect(url_for('main.manage_quick_replies', scope=scope_id))
     line_accounts = LineAccount.query.order_by(LineAccount.name).all()
@@ -330,6 +463,7 @@ def edit_quick_reply(qr_id):
         qr.name = request.form.get("name")
         qr.text = request.form.get("text")
         db.session.commit()
+        quick_reply_index.upsert(qr)
         flash("Quick Reply updated successfully.", "success")
         scope = qr.line_account_id or 'global'
         return redirect(url_for('main.manage_quick_replies', scope=scope))
@@ -343,23 +477,280 @@ def delete_quick_reply(qr_id):
     scope_to_redirect = qr.line_account_id or 'global'
     db.session.delete(qr)
     db.session.commit()
+    quick_reply_index.remove(qr_id)
     flash("Quick reply deleted.", "info")
     return redirect(url_for('main.manage_quick_replies', scope=scope_to_redirect))
 
 @bp.route("/api/quick_replies")
 @login_required
 def api_quick_replies():
+    # ค้นจาก index ในหน่วยความจำ (global + OA ของห้องแชท) คืนเฉพาะ top-K ที่ตรงที่สุด
     query_str = request.args.get('q', '')
-    line_account_id_str = request.args.get('line_account_id')
+    line_account_id = request.args.get('line_account_id', type=int)
     if not query_str: return jsonify([])
-    base_query = QuickReply.query.filter(QuickReply.name.contains(query_str))
-    if line_account_id_str:
-        final_query = base_query.filter(or_(QuickReply.line_account_id.is_(None), QuickReply.line_account_id == int(line_account_id_str)))
-    else:
-        final_query = base_query.filter(QuickReply.line_account_id.is_(None))
-    all_replies = final_query.all()
-    results = [{'id': qr.id, 'name': qr.name, 'text': qr.text} for qr in all_replies]
-    return jsonify(results)
+    results = quick_reply_index.search(query_str, line_account_id)
+    return jsonify([{'id': qr.id, 'name': qr.name, 'text': qr.text} for qr in results])
+
+@bp.route("/api/quick_replies/scope")
+@login_required
+def api_quick_reply_scope():
+    # รายการทั้งหมดของ scope ให้หน้าแชทเก็บไว้กรองเองระหว่างพิมพ์
+    replies = quick_reply_index.scope_list(request.args.get('line_account_id', type=int))
+    response = jsonify([{'id': qr.id, 'name': qr.name, 'text': qr.text} for qr in replies])
+    response.headers['Cache-Control'] = 'private, max-age=60'
+    return response
+
+# ===================== Search =====================
+def parse_date_arg(name):
+    value = request.args.get(name, '').strip()
+    try:
+        return datetime.date.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+@bp.route("/search")
+@login_required
+def search():
+    q = request.args.get('q', '').strip()
+    customer_id = request.args.get('user_id', type=int)
+    line_account_id = request.args.get('line_account_id', type=int)
+    date_from = parse_date_arg('date_from')
+    date_to = parse_date_arg('date_to')
+    messages, has_more = search_messages(
+        q,
+        user_id=customer_id,
+        line_account_id=line_account_id,
+        date_from=datetime.datetime.combine(date_from, datetime.time.min) if date_from else None,
+        # date_to รวมทั้งวันนั้น
+        date_to=datetime.datetime.combine(date_to + datetime.timedelta(days=1), datetime.time.min) if date_to else None,
+        before_id=request.args.get('before_id', type=int),
+        limit=current_app.config['SEARCH_PAGE_SIZE'],
+    )
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'messages': [dict(serialize_message(m), snippet=str(highlight(m.text, q))) for m in messages],
+            'has_more': has_more,
+        })
+    accounts = line_clients.accounts()
+    return render_template(
+        "search.html",
+        q=q,
+        messages=messages,
+        has_more=has_more,
+        customer=db.session.get(User, customer_id) if customer_id else None,
+        line_accounts=accounts,
+        accounts_by_id={acc.id: acc for acc in accounts},
+        line_account_id=line_account_id,
+        date_from=date_from.isoformat() if date_from else None,
+        date_to=date_to.isoformat() if date_to else None,
+        highlight=highlight,
+    )
+
+# ===================== Conversation & Read State =====================
+def touch_conversation(user_id, msg, line_account_id=None):
+    # อัปเดตตารางสรุปห้องแชทใน transaction เดียวกับข้อความ (ไม่ commit เอง)
+    conv = Conversation.query.filter_by(user_id=user_id).first()
+    if conv is None:
+        conv = Conversation(user_id=user_id)
+        db.session.add(conv)
+    if msg.timestamp is None:
+        msg.timestamp = datetime.datetime.utcnow()
+    # LINE อาจส่ง event มาไม่เรียงเวลา จึงไม่เขียนทับด้วยข้อความที่เก่ากว่า
+    if conv.last_message_at is None or msg.timestamp >= conv.last_message_at:
+        conv.last_message = msg
+        conv.last_message_at = msg.timestamp
+        conv.last_message_type = msg.message_type
+        conv.last_message_preview = (msg.text or '')[:255] if msg.message_type == 'text' else None
+    if line_account_id:
+        conv.line_account_id = line_account_id
+    return conv
+
+def increment_unread(user_id, staff_members, messages):
+    # เพิ่มตัวนับข้อความที่ยังไม่อ่านของ staff ทุกคนด้วย UPDATE เดียว (ไม่ commit เอง)
+    # messages = ข้อความขาเข้าใหม่ของลูกค้าคนนี้ที่ flush แล้ว (ต้องมี id)
+    count = len(messages)
+    staff_ids = [s.id for s in staff_members]
+    existing = {
+        staff_id for (staff_id,) in
+        db.session.query(ReadState.staff_id).filter(ReadState.user_id == user_id, ReadState.staff_id.in_(staff_ids))
+    }
+    if existing:
+        ReadState.query.filter(ReadState.user_id == user_id, ReadState.staff_id.in_(existing)).update(
+            {ReadState.unread_count: ReadState.unread_count + count}, synchronize_session=False)
+    # staff ที่ยังไม่เคยมี ReadState ของห้องนี้: นับว่าอ่านถึงก่อนข้อความใหม่ชุดนี้
+    # ให้ตรงกับนิยามของ unread.reconcile_unread_counts (ข้อความที่ id > last_read_message_id)
+    last_read_message_id = min(msg.id for msg in messages) - 1
+    for staff_id in staff_ids:
+        if staff_id not in existing:
+            db.session.add(ReadState(staff_id=staff_id, user_id=user_id,
+                                     last_read_message_id=last_read_message_id, unread_count=count))
+
+def conversation_page_query(staff_id, page, per_page):
+    # ดึงเกินมา 1 แถวเพื่อรู้ว่ามีหน้าถัดไปหรือไม่
+    return (
+        db.session.query(Conversation, User, ReadState.unread_count)
+        .join(User, User.id == Conversation.user_id)
+        .outerjoin(ReadState, and_(ReadState.user_id == Conversation.user_id, ReadState.staff_id == staff_id))
+        .order_by(Conversation.last_message_at.desc().nulls_last(), Conversation.id.desc())
+        .offset((page - 1) * per_page)
+        .limit(per_page + 1)
+    )
+
+def get_unread_counts(user_id):
+    return dict(
+        db.session.query(ReadState.staff_id, ReadState.unread_count)
+        .filter(ReadState.user_id == user_id).all()
+    )
+
+def get_unread_counts_for(user_ids):
+    # เหมือน get_unread_counts แต่หลายห้องใน query เดียว: {user_id: {staff_id: unread_count}}
+    counts = {}
+    rows = (
+        db.session.query(ReadState.user_id, ReadState.staff_id, ReadState.unread_count)
+        .filter(ReadState.user_id.in_(user_ids)).all()
+    )
+    for user_id, staff_id, unread_count in rows:
+        counts.setdefault(user_id, {})[staff_id] = unread_count
+    return counts
+
+def mark_conversation_read(staff_id, user_id):
+    # ไม่ commit เอง คืน True ถ้ามีการเปลี่ยนแปลงที่ต้อง commit
+    last_id = db.session.query(func.max(Message.id)).filter(Message.user_id == user_id).scalar()
+    if not last_id:
+        return False
+    state = (
+        db.session.query(ReadState.last_read_message_id, ReadState.unread_count)
+        .filter_by(staff_id=staff_id, user_id=user_id).first()
+    )
+    if state is None:
+        db.session.add(ReadState(staff_id=staff_id, user_id=user_id, last_read_message_id=last_id, unread_count=0))
+        return True
+    if state.last_read_message_id >= last_id and not state.unread_count:
+        return False
+    # webhook อาจ commit ข้อความใหม่ (+unread) หลังอ่าน MAX(id) ด้านบน จึงไม่เขียน 0 ทับ
+    # แต่นับข้อความที่ใหม่กว่าตำแหน่งที่อ่านในคำสั่ง UPDATE เดียวกัน (นิยามเดียวกับ unread.reconcile_unread_counts)
+    last_read = case((ReadState.last_read_message_id < last_id, last_id), else_=ReadState.last_read_message_id)
+    unread = (
+        select(func.count(Message.id))
+        .where(Message.user_id == user_id, Message.id > last_read)
+        .scalar_subquery()
+    )
+    ReadState.query.filter_by(staff_id=staff_id, user_id=user_id).update(
+        {ReadState.last_read_message_id: last_read, ReadState.unread_count: unread}, synchronize_session=False)
+    return True
+
+# ===================== Chat History =====================
+def fetch_history_page(user_id, before_ts=None, before_id=None, limit=50):
+    # คืนข้อความหนึ่งหน้า (เรียงเก่า -> ใหม่) ที่เก่ากว่า cursor (timestamp, id)
+    # ขาเข้า (user_id) กับขาออก (recipient_id) แยกเป็นสอง subquery ให้แต่ละฝั่งไล่ index (x_id, timestamp, id)
+    # ถอยหลังแล้วหยุดที่ limit+1 แถว ถ้าใช้ OR ในคำสั่งเดียว planner ต้อง sort เองหรือไล่ index timestamp ทั้งตาราง
+    def side(column):
+        query = select(Message).where(column == user_id)
+        if before_ts is not None and before_id is not None:
+            query = query.where(or_(
+                Message.timestamp < before_ts,
+                and_(Message.timestamp == before_ts, Message.id < before_id)
+            ))
+        return select(query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit + 1).subquery())
+
+    stmt = union_all(side(Message.user_id), side(Message.recipient_id))
+    rows = db.session.execute(select(Message).from_statement(stmt)).scalars().unique().all()
+    # รวมสองฝั่ง (รวมกันไม่เกิน 2 * (limit+1) แถว) แล้วตัดหน้าใน Python
+    rows.sort(key=lambda msg: (msg.timestamp or datetime.datetime.min, msg.id), reverse=True)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, has_more
+
+def history_cursor(messages):
+    if not messages:
+        return None
+    oldest = messages[0]
+    return {'before_ts': oldest.timestamp.isoformat(), 'before_id': oldest.id}
+
+@bp.route("/api/chat_history/<int:user_id>")
+@login_required
+def api_chat_history(user_id):
+    before_ts = request.args.get('before_ts')
+    before_id = request.args.get('before_id', type=int)
+    try:
+        before_ts = datetime.datetime.fromisoformat(before_ts) if before_ts else None
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    limit = max(1, min(request.args.get('limit', current_app.config['HISTORY_PAGE_SIZE'], type=int), 200))
+    messages, has_more = fetch_history_page(user_id, before_ts, before_id, limit)
+    html = ''.join(render_message_bubble(msg) for msg in messages)
+    return jsonify({
+        'html': html,
+        'count': len(messages),
+        'has_more': has_more,
+        'cursor': history_cursor(messages),
+    })
+
+# ===================== Outbound delivery =====================
+def public_base_url():
+    base_url = current_app.config.get("BASE_URL")
+    if base_url and '127.0.0.1' not in base_url and 'localhost' not in base_url:
+        return base_url.rstrip('/')
+    return None
+
+def build_line_message(msg):
+    if msg.message_type == 'image':
+        full_image_url = absolute_media_url(msg.media_url)
+        preview_image_url = absolute_media_url(msg.media_url, 'preview')
+        return ImageSendMessage(original_content_url=full_image_url, preview_image_url=preview_image_url)
+    if msg.message_type == 'sticker':
+        return StickerSendMessage(package_id=msg.package_id, sticker_id=msg.sticker_id)
+    return TextSendMessage(text=msg.text)
+
+def set_delivery_status(msg, status, error=None):
+    msg.delivery_status = status
+    msg.delivery_error = error[:255] if error else None
+    db.session.commit()
+    payload = {'message_id': msg.id, 'user_id': msg.recipient_id, 'status': status, 'error': msg.delivery_error}
+    for staff_member in staff_roster.online():
+        socketio.emit('message_status', payload, to=staff_room(staff_member.id))
+
+def deliver_outbound_message(message_id, attempt):
+    # เรียกจาก worker ของ outbound_queue; raise RetryLater เมื่อควรลองส่งใหม่
+    msg = db.session.get(Message, message_id)
+    if msg is None or msg.delivery_status != 'pending':
+        return
+    acc = line_clients.account(msg.line_account_id)
+    if acc is None or msg.recipient is None or not msg.recipient.line_user_id:
+        set_delivery_status(msg, 'failed', 'LINE account or recipient no longer exists')
+        return
+    msg.delivery_attempts = attempt
+    db.session.commit()
+    # retry key เดียวกันทุกครั้ง LINE จะไม่ส่งซ้ำถ้าครั้งก่อนสำเร็จไปแล้ว (ตอบ 409)
+    retry_key = str(uuid.uuid5(uuid.NAMESPACE_URL, f"line-push/message/{msg.id}"))
+    try:
+        line_clients.get_api(acc).push_message(msg.recipient.line_user_id, build_line_message(msg), retry_key=retry_key)
+    except LineBotApiError as e:
+        if e.status_code == 409:
+            pass
+        elif e.status_code == 429 or e.status_code >= 500:
+            raise RetryLater(f"LINE API {e.status_code}: {e.error.message}")
+        else:
+            set_delivery_status(msg, 'failed', f"LINE API {e.status_code}: {e.error.message}")
+            return
+    except requests.RequestException as e:
+        raise RetryLater(str(e))
+    set_delivery_status(msg, 'sent')
+
+def fail_outbound_message(message_id, error):
+    msg = db.session.get(Message, message_id)
+    if msg is not None and msg.delivery_status == 'pending':
+        set_delivery_status(msg, 'failed', error)
+
+def pending_outbound_messages():
+    # ใส่ 'pending' เป็น literal ใน SQL ให้ planner ใช้ partial index ix_message_delivery_pending ได้
+    return (
+        db.session.query(Message.id, Message.line_account_id)
+        .filter(Message.delivery_status == literal('pending', literal_execute=True))
+        .order_by(Message.id)
+        .all()
+    )
 
 # ===================== Chat =====================
 @bp.route("/chat_all", methods=["GET"])
@@ -371,96 +762,83 @@ def chat_all(user_id=None):
     # Step 1: Handle POST request first (sending a message)
     if request.method == "POST" and selected_user:
         text = request.form.get("message", "").strip()
-        line_account_to_use = LineAccount.query.first()
+        # ตอบกลับจาก OA ที่ลูกค้าทักเข้ามา (index ในหน่วยความจำ ไม่ต้อง query ทุกครั้ง)
+        line_account_to_use = line_clients.account_for_customer(selected_user.id)
         if not line_account_to_use:
             flash("No configured LINE Account to send message from.", "danger")
             return redirect(url_for("main.chat_all", user_id=user_id))
         
+        # บันทึกข้อความเป็น pending แล้วให้ outbound_queue ส่งไป LINE เบื้องหลัง ไม่ต้องรอ LINE ตอบ
         saved_msg = None
         try:
-            line_bot_api = LineBotApi(line_account_to_use.channel_access_token)
             image_match = re.search(r'\[\[IMAGE:([^\s]+)\]\]', text)
             sticker_match = re.search(r'\[\[STICKER:(\d+),(\d+)\]\]', text)
 
             if image_match:
-                image_path = image_match.group(1)
-                filename = os.path.basename(image_path)
-                base_url = current_app.config.get("BASE_URL")
-                if base_url and '127.0.0.1' not in base_url and 'localhost' not in base_url:
-                    full_image_url = f"{base_url.rstrip('/')}{image_path}"
-                    line_bot_api.push_message(selected_user.line_user_id, ImageSendMessage(original_content_url=full_image_url, preview_image_url=full_image_url))
-                else:
+                filename = os.path.basename(image_match.group(1))
+                saved_msg = Message(text=text, message_type="image", media_url=filename, user_id=current_user.id, recipient_id=selected_user.id, line_account_id=line_account_to_use.id, delivery_status='pending')
+                if not public_base_url() and not media_storage.public_base_url:
                     flash("รูปภาพถูกบันทึกในแชทแอดมินแล้ว แต่ไม่ได้ส่งหาลูกค้าใน LINE เนื่องจากไม่ได้ตั้งค่า BASE_URL ให้เป็น Public", "warning")
-                saved_msg = Message(text=text, message_type="image", media_url=filename, user_id=current_user.id, recipient_id=selected_user.id, is_read=True, line_account_id=line_account_to_use.id)
+                    saved_msg.delivery_status = 'failed'
+                    saved_msg.delivery_error = 'BASE_URL is not public'
 
             elif sticker_match:
                 package_id, sticker_id = sticker_match.groups()
-                line_bot_api.push_message(selected_user.line_user_id, StickerSendMessage(package_id=package_id, sticker_id=sticker_id))
-                saved_msg = Message(message_type="sticker", package_id=package_id, sticker_id=sticker_id, user_id=current_user.id, recipient_id=selected_user.id, is_read=True, line_account_id=line_account_to_use.id)
+                saved_msg = Message(message_type="sticker", package_id=package_id, sticker_id=sticker_id, user_id=current_user.id, recipient_id=selected_user.id, line_account_id=line_account_to_use.id, delivery_status='pending')
                 
             elif text:
-                line_bot_api.push_message(selected_user.line_user_id, TextSendMessage(text=text))
-                saved_msg = Message(text=text, message_type="text", user_id=current_user.id, recipient_id=selected_user.id, is_read=True, line_account_id=line_account_to_use.id)
+                saved_msg = Message(text=text, message_type="text", user_id=current_user.id, recipient_id=selected_user.id, line_account_id=line_account_to_use.id, delivery_status='pending')
             
             if saved_msg:
                 db.session.add(saved_msg)
+                conversation = touch_conversation(selected_user.id, saved_msg)
                 db.session.commit()
-                all_staff = User.query.filter(User.role.in_(['admin', 'staff', 'owner'])).all()
-                for staff_member in all_staff:
-                    unread_count = Message.query.filter_by(user_id=selected_user.id, recipient_id=staff_member.id, is_read=False).count()
-                    user_data = {'user_info': selected_user, 'last_message': saved_msg, 'unread_count': unread_count}
-                    user_list_item_html = render_template_string(USER_LIST_ITEM_HTML, data=user_data)
-                    message_bubble_html = render_template_string(MESSAGE_BUBBLE_HTML, msg=saved_msg, current_user=current_user)
-                    socketio.emit('update_chat', {'user_id': selected_user.id, 'recipient_id': staff_member.id, 'user_list_item_html': user_list_item_html, 'message_bubble_html': message_bubble_html})
+                if saved_msg.delivery_status == 'pending':
+                    outbound_queue.enqueue(saved_msg.id, line_account_to_use.id)
+                unread_counts = get_unread_counts(selected_user.id)
+                emit_chat_update(selected_user, conversation, [saved_msg], staff_roster.online(), unread_counts)
         except Exception as e:
+            db.session.rollback()
             flash(f"Failed to send message: {str(e)}", "danger")
         return redirect(url_for("main.chat_all", user_id=user_id))
 
     # Step 2: Mark messages as read if a user is selected
     if selected_user:
-        Message.query.filter_by(user_id=selected_user.id, recipient_id=current_user.id, is_read=False).update({'is_read': True})
-        db.session.commit()
+        if mark_conversation_read(current_user.id, selected_user.id):
+            db.session.commit()
 
-    # Step 3: Fetch the list of all customer users ('guest' role)
-    guest_users = User.query.filter_by(role='guest').all()
+    # Step 3: Fetch one page of conversations, newest first, from the summary table
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = current_app.config['CONVERSATIONS_PER_PAGE']
+    rows = conversation_page_query(current_user.id, page, per_page).all()
+    has_more_conversations = len(rows) > per_page
 
     # Step 4: Prepare data for the template
-    users_data = []
-    for user in guest_users:
-        last_message = Message.query.filter(
-            or_(Message.user_id == user.id, Message.recipient_id == user.id)
-        ).order_by(Message.timestamp.desc()).first()
-        
-        unread_count = Message.query.filter_by(user_id=user.id, recipient_id=current_user.id, is_read=False).count()
-        
-        users_data.append({
-            'user_info': user, 
-            'last_message': last_message, 
-            'unread_count': unread_count
-        })
+    users_data = [
+        {'user_info': user, 'conversation': conversation, 'unread_count': unread_count or 0}
+        for conversation, user, unread_count in rows[:per_page]
+    ]
 
-    users_data.sort(key=lambda x: x['last_message'].timestamp if x['last_message'] else datetime.datetime.min, reverse=True)
-
-    # Step 5: Get messages for the selected chat window
+    # Step 5: Get the latest page of messages for the selected chat window
     messages = []
+    has_more_history = False
     line_account_context_id = None
     if selected_user:
-        messages = Message.query.filter(
-            or_(
-                and_(Message.user_id == selected_user.id, Message.recipient_id == current_user.id),
-                and_(Message.user_id == current_user.id, Message.recipient_id == selected_user.id)
-            )
-        ).order_by(Message.timestamp.asc()).all()
-        last_customer_message = Message.query.filter_by(user_id=selected_user.id).order_by(Message.timestamp.desc()).first()
-        if last_customer_message:
-            line_account_context_id = last_customer_message.line_account_id
+        messages, has_more_history = fetch_history_page(selected_user.id, limit=current_app.config['HISTORY_PAGE_SIZE'])
+        line_account_context = line_clients.account_for_customer(selected_user.id)
+        if line_account_context:
+            line_account_context_id = line_account_context.id
 
     # Step 6: Render the final template
     return render_template(
         "chat.html", 
         users_data=users_data, 
+        page=page,
+        has_more_conversations=has_more_conversations,
         selected_user=selected_user, 
         messages=messages, 
+        has_more_history=has_more_history,
+        history_cursor=history_cursor(messages),
         line_account_context_id=line_account_context_id
     )
 
@@ -475,91 +853,262 @@ def upload_image():
         return jsonify({'error': 'No selected file'}), 400
     
     if file:
-        filename = secure_filename(file.filename)
-        filename = f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{filename}"
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-
-        os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True)
-
+        # เก็บผ่าน media_storage ชื่อไฟล์ตาม hash ของเนื้อหา (อัปโหลดรูปเดิมซ้ำได้ไฟล์เดิม)
+        chunk_size = current_app.config['MEDIA_CHUNK_SIZE']
         try:
-            file.save(filepath)
+            filename, content_type, size = ingest_stream(
+                iter(lambda: file.stream.read(chunk_size), b''),
+                current_app.config['MEDIA_MAX_BYTES'],
+                declared_type=file.mimetype,
+            )
+        except MediaTooLarge as e:
+            return jsonify({'error': str(e)}), 413
         except Exception as e:
             return jsonify({'error': f'Failed to save file: {str(e)}'}), 500
-        image_path = url_for('static', filename=f'uploads/{filename}')
-        return jsonify({'success': True, 'image_url': image_path})
+        return jsonify({'success': True, 'image_url': media_url_for(filename)})
+
+# ===================== Media =====================
+@bp.route("/media/<path:key>")
+def media_file(key):
+    # key ตั้งจาก hash ของเนื้อหา ไฟล์ไม่เปลี่ยนจึงให้ browser/CDN cache ได้ตลอด (LINE ต้องดึงรูปได้โดยไม่ login)
+    if '..' in key.split('/'):
+        abort(404)
+    if media_storage.is_local:
+        response = send_from_directory(media_storage.backend.root, key, conditional=True, etag=key, max_age=media_storage.max_age)
+    elif request.if_none_match.contains(key):
+        response = Response(status=304)
+    else:
+        try:
+            obj = media_storage.backend.get(key, request.headers.get('Range'))
+        except MediaRangeError:
+            abort(416)
+        if obj is None:
+            abort(404)
+        chunks = obj['Body'].iter_chunks(chunk_size=current_app.config['MEDIA_CHUNK_SIZE'])
+        response = Response(chunks, status=206 if obj.get('ContentRange') else 200,
+                            mimetype=obj.get('ContentType'), direct_passthrough=True)
+        response.content_length = obj['ContentLength']
+        response.accept_ranges = 'bytes'
+        if obj.get('ContentRange'):
+            response.headers['Content-Range'] = obj['ContentRange']
+    response.set_etag(key)
+    response.headers['Cache-Control'] = media_storage.cache_control
+    return response
 
 # ===================== Webhook =====================
 @bp.route("/webhook/<int:line_account_id>", methods=["POST"])
 def webhook(line_account_id):
-    acc = LineAccount.query.get_or_404(line_account_id)
-    handler = WebhookHandler(acc.channel_secret)
-    def process_and_save_message(event, msg_type, **kwargs):
-        line_bot_api = LineBotApi(acc.channel_access_token)
-        profile = line_bot_api.get_profile(event.source.user_id)
-        user = get_or_create_line_user(profile, event.source.user_id)
-        
-        # Check if user creation was successful
-        if not user:
-            print(f"ERROR: Could not get or create user for line_user_id: {event.source.user_id}")
-            return
-
-        all_staff = User.query.filter(User.role.in_(['admin', 'staff', 'owner'])).all()
-        if not all_staff: return
-
-        for staff_member in all_staff:
-            msg_data = {'message_type': msg_type, 'user_id': user.id, 'recipient_id': staff_member.id, 'line_account_id': acc.id, 'timestamp': datetime.datetime.utcfromtimestamp(event.timestamp / 1000), 'is_read': False}
-            msg_data.update(kwargs)
-            msg = Message(**msg_data)
-            db.session.add(msg)
-        
-        # A single commit for all operations in this request (user creation/update and message saving)
-        try:
-            db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            print(f"ERROR during webhook db.session.commit(): {e}")
-            return
-            
-        # Refetch the message from the database to ensure it has an ID for the template
-        # Note: This is simplified; a better way might be to use session flushing, but this is clear and safe.
-        last_message_for_socket = Message.query.filter_by(user_id=user.id).order_by(Message.timestamp.desc()).first()
-
-        for staff_member in all_staff:
-            unread_count = Message.query.filter_by(user_id=user.id, recipient_id=staff_member.id, is_read=False).count()
-            user_data = {'user_info': user, 'last_message': last_message_for_socket, 'unread_count': unread_count}
-            user_list_item_html = render_template_string(USER_LIST_ITEM_HTML, data=user_data)
-            message_bubble_html = render_template_string(MESSAGE_BUBBLE_HTML, msg=last_message_for_socket, current_user=current_user)
-            socketio.emit('update_chat', {'user_id': user.id, 'recipient_id': staff_member.id, 'user_list_item_html': user_list_item_html, 'message_bubble_html': message_bubble_html})
-
-    @handler.add(MessageEvent, message=TextMessage)
-    def handle_text_message(event):
-        process_and_save_message(event, 'text', text=event.message.text)
-    @handler.add(MessageEvent, message=StickerMessage)
-    def handle_sticker_message(event):
-        process_and_save_message(event, 'sticker', sticker_id=event.message.sticker_id, package_id=event.message.package_id)
-    @handler.add(MessageEvent, message=ImageMessage)
-    def handle_image_message(event):
-        line_bot_api = LineBotApi(acc.channel_access_token)
-        message_content = line_bot_api.get_message_content(event.message.id)
-        filename = f"{event.message.id}.jpg"
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-        with open(filepath, 'wb') as fd:
-            for chunk in message_content.iter_content():
-                fd.write(chunk)
-        process_and_save_message(event, 'image', media_url=filename)
-
-    signature = request.headers['X-Line-Signature']
+    # ตรวจลายเซ็นแล้วบันทึก event ลงคิวถาวร ตอบ OK ทันที ส่วนการประมวลผลทำใน worker
+    acc = line_clients.account(line_account_id)
+    if acc is None:
+        abort(404)
+    signature = request.headers.get('X-Line-Signature', '')
     body = request.get_data(as_text=True)
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
+    if not line_clients.get_validator(acc).validate(body, signature):
         return "Invalid signature", 400
+    try:
+        events = json.loads(body).get('events', [])
+    except ValueError:
+        return "Invalid body", 400
+    webhook_queue.enqueue(acc.id, events)
     return "OK"
 
-def get_or_create_line_user(profile, line_user_id):
+@bp.before_app_request
+def start_background_workers():
+    app = current_app._get_current_object()
+    if not app.config['BACKGROUND_WORKERS']:
+        return
+    webhook_queue.start(app, process_webhook_events)
+    outbound_queue.start(app, deliver_outbound_message, fail_outbound_message, pending_outbound_messages)
+    media_downloader.start(app, attach_downloaded_media, fail_media_download, pending_media_downloads)
+    unread_reconciler.start(app)
+
+# ฟิลด์ที่ inbound_message_fields อาจคืน (ชนิดที่ไม่ใช้ได้ None)
+INBOUND_MESSAGE_FIELDS = ('text', 'sticker_id', 'package_id', 'media_url')
+
+def inbound_message_fields(event):
+    # แปลง MessageEvent เป็น (message_type, ฟิลด์ของ Message); None = ชนิดที่ไม่รองรับ
+    message = event.message
+    if isinstance(message, TextMessage):
+        return 'text', {'text': message.text}
+    if isinstance(message, StickerMessage):
+        return 'sticker', {'sticker_id': message.sticker_id, 'package_id': message.package_id}
+    if isinstance(message, ImageMessage):
+        # บันทึกข้อความพร้อม placeholder ก่อน แล้วให้ media_downloader ดึงไฟล์จาก LINE เบื้องหลัง
+        return 'image', {'media_url': Message.PENDING_MEDIA_PREFIX + message.id}
+    return None
+
+def fetch_line_profiles(keys, accounts):
+    # keys = [(line_account_id, line_user_id), ...]; โปรไฟล์ที่ไม่อยู่ในแคชเรียก get_profile พร้อมกัน
+    pile = eventlet.GreenPile()
+    for line_account_id, line_user_id in keys:
+        api = line_clients.get_api(accounts[line_account_id])
+        pile.spawn(profile_cache.get, line_account_id, line_user_id,
+                   lambda api=api, line_user_id=line_user_id: api.get_profile(line_user_id))
+    return dict(zip(keys, pile))
+
+def resolve_line_users(profiles):
+    # ดึง User ที่มีอยู่แล้วของทั้งชุดด้วย query เดียว แล้ว sync/สร้างทีละคนใน session (ไม่ commit เอง)
+    line_user_ids = {line_user_id for _, line_user_id in profiles}
+    known_users = {u.line_user_id: u for u in User.query.filter(User.line_user_id.in_(line_user_ids))}
+    users = {}
+    for (line_account_id, line_user_id), profile in profiles.items():
+        user = get_or_create_line_user(profile, line_user_id, line_account_id, known_users=known_users)
+        known_users[line_user_id] = users[line_user_id] = user
+    return users
+
+def ingested_line_message_ids(line_message_ids):
+    # LINE message id ที่บันทึกไปแล้ว (event ที่ LINE ส่งซ้ำ) ใช้ unique index ix_message_line_message_id
+    if not line_message_ids:
+        return []
+    return [
+        line_message_id for (line_message_id,) in
+        db.session.query(Message.line_message_id).filter(Message.line_message_id.in_(line_message_ids))
+    ]
+
+def process_webhook_events(events):
+    # เรียกจาก worker ของ webhook_queue ทีละชุด events = [(line_account_id, payload), ...]
+    # (มี request context จำลองให้ url_for/render ใช้งานได้) ทั้งชุด commit ครั้งเดียว
+    accounts = {}
+    parsed = {}
+    for line_account_id, payload in events:
+        acc = line_clients.account(line_account_id)
+        if acc is None or payload.get('type') != 'message':
+            continue
+        event = MessageEvent.new_from_json_dict(payload)
+        fields = inbound_message_fields(event)
+        if fields is None:
+            continue
+        accounts[acc.id] = acc
+        # LINE ส่ง event เดิมซ้ำได้ (redelivery) ใช้ message id ของ LINE เป็นตัวกันซ้ำ
+        parsed.setdefault(event.message.id, (acc, event) + fields)
+    for line_message_id in ingested_line_message_ids(list(parsed)):
+        del parsed[line_message_id]
+    if not parsed:
+        return
+    parsed = list(parsed.values())
+
+    # ข้อความต้องถูกบันทึกเสมอแม้ยังไม่มี staff (journal จะ ack ชุดนี้ทิ้ง) ที่ขึ้นกับ staff มีแค่ตัวนับ unread และการ emit
+    all_staff = staff_roster.members()
+
+    profile_keys = list(dict.fromkeys((acc.id, event.source.user_id) for acc, event, _, _ in parsed))
+    profiles = fetch_line_profiles(profile_keys, accounts)
+    users = resolve_line_users(profiles)
+    # ผู้ใช้ใหม่ยังไม่มี id จนกว่าจะ flush
+    db.session.flush()
+
+    # ข้อความขาเข้าเก็บแถวเดียว สถานะการอ่านของ staff แต่ละคนอยู่ใน ReadState
+    # INSERT ทั้งชุดเป็นคำสั่งเดียว (insertmanyvalues) add_all+flush ของ ORM บน SQLite จะ INSERT ทีละแถว
+    # เพราะจับคู่ id ที่ RETURNING คืนมากับแถวตามลำดับไม่ได้ จึงจับคู่เองด้วย line_message_id (unique)
+    # ทุกแถวต้องมีคีย์ชุดเดียวกัน (ค่า None ต้อง render_nulls ด้วย) ไม่อย่างนั้น SQLAlchemy จะแยก INSERT ตามชนิดข้อความ
+    rows = []
+    for acc, event, msg_type, fields in parsed:
+        row = dict.fromkeys(INBOUND_MESSAGE_FIELDS)
+        row.update(fields, message_type=msg_type, user_id=users[event.source.user_id].id, line_account_id=acc.id,
+                   line_message_id=event.message.id, webhook_event_id=event.webhook_event_id,
+                   timestamp=datetime.datetime.utcfromtimestamp(event.timestamp / 1000))
+        rows.append(row)
+    inserted = {
+        msg.line_message_id: msg for msg in
+        db.session.scalars(insert(Message).returning(Message), rows, execution_options={'render_nulls': True})
+    }
+    by_user = {}
+    for acc, event, _, _ in parsed:
+        user = users[event.source.user_id]
+        by_user.setdefault(user.id, (user, []))[1].append((acc, inserted[event.message.id], event.message.id))
+
+    conversations = {}
+    for user_id, (user, items) in by_user.items():
+        # touch_conversation เก็บเฉพาะข้อความล่าสุดอยู่แล้ว จึงเรียกครั้งเดียวด้วยข้อความใหม่สุดของห้อง
+        acc, latest, _ = max(reversed(items), key=lambda item: item[1].timestamp)
+        conversations[user_id] = touch_conversation(user_id, latest, line_account_id=acc.id)
+        if all_staff:
+            increment_unread(user_id, all_staff, [msg for _, msg, _ in items])
+    db.session.flush()
+
+    # ทุกแถวมี id แล้ว จึง render/serialize จากอ็อบเจกต์ใน session ได้เลย ไม่ต้อง query กลับ
+    # (หลัง commit อ็อบเจกต์จะถูก expire การแตะ attribute จะ query ใหม่ทีละแถว จึงเตรียมทุกอย่างก่อน commit)
+    unread_counts = get_unread_counts_for(list(by_user))
+    online_staff = staff_roster.online()
+    payloads = []
+    downloads = []
+    for user_id, (user, items) in by_user.items():
+        messages = [msg for _, msg, _ in items]
+        payloads.extend(chat_update_payloads(user, conversations[user_id], messages, online_staff,
+                                             unread_counts.get(user_id, {})))
+        downloads.extend((msg.id, acc.id, line_message_id) for acc, msg, line_message_id in items if msg.media_pending)
+    synced = [(key, profile, users[key[1]].id) for key, profile in profiles.items()]
+    customer_accounts = {user_id: conversation.line_account_id for user_id, conversation in conversations.items()}
+
+    # A single commit for all operations in this batch (user creation/update and message saving)
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"ERROR during webhook db.session.commit(): {e}")
+        raise  # ให้คิวลองประมวลผลชุดนี้ใหม่
+    for (line_account_id, line_user_id), profile, user_id in synced:
+        profile_cache.mark_synced(line_account_id, line_user_id, profile, user_id)
+    for user_id, line_account_id in customer_accounts.items():
+        line_clients.remember_customer(user_id, line_account_id)
+    for download in downloads:
+        media_downloader.enqueue(*download)
+    emit_payloads(payloads)
+
+def emit_media_update(msg):
+    payload = {'message_id': msg.id, 'user_id': msg.user_id, 'media_url': None, 'thumbnail_url': None, 'error': None}
+    if msg.media_url:
+        payload['media_url'] = media_url_for(msg.media_url)
+        payload['thumbnail_url'] = media_url_for(msg.media_url, 'thumb')
+    else:
+        payload['error'] = msg.text
+    for staff_member in staff_roster.online():
+        socketio.emit('message_media', payload, to=staff_room(staff_member.id))
+
+def attach_downloaded_media(message_id, filename, content_type, size):
+    msg = db.session.get(Message, message_id)
+    if msg is None or not msg.media_pending:
+        return
+    msg.media_url = filename
+    db.session.commit()
+    emit_media_update(msg)
+
+def fail_media_download(message_id, error):
+    msg = db.session.get(Message, message_id)
+    if msg is None or not msg.media_pending:
+        return
+    msg.media_url = None
+    msg.text = f"ดาวน์โหลดรูปภาพไม่สำเร็จ: {error}"[:255]
+    db.session.commit()
+    emit_media_update(msg)
+
+def pending_media_downloads():
+    rows = (
+        db.session.query(Message.id, Message.line_account_id, Message.media_url)
+        # pattern เป็น literal ใน SQL ให้ตรงกับเงื่อนไขของ partial index ix_message_media_pending
+        .filter(Message.message_type == 'image',
+                Message.media_url.like(literal(Message.PENDING_MEDIA_PREFIX + '%', literal_execute=True)))
+        .order_by(Message.id)
+        .all()
+    )
+    return [(msg_id, line_account_id, media_url[len(Message.PENDING_MEDIA_PREFIX):]) for msg_id, line_account_id, media_url in rows]
+
+def get_or_create_line_user(profile, line_user_id, line_account_id=None, known_users=None):
     # This function now only adds users to the session, it does not commit.
-    # The commit is handled by the calling function (process_and_save_message).
-    user = User.query.filter_by(line_user_id=line_user_id).first()
+    # The commit is handled by the calling function (process_webhook_events).
+    # known_users: {line_user_id: User} ที่ดึงมาล่วงหน้าแล้ว (ไม่มีใน dict = ผู้ใช้ใหม่)
+
+    # โปรไฟล์ในแคชไม่เปลี่ยนจากที่บันทึกไว้แล้ว: ดึง User ด้วย primary key ครั้งเดียว ไม่ต้องเทียบชื่อซ้ำ
+    synced_user_id = profile_cache.synced_user_id(line_account_id, line_user_id, profile)
+    if synced_user_id:
+        user = db.session.get(User, synced_user_id)
+        if user is not None and user.line_user_id == line_user_id:
+            return user
+
+    if known_users is not None:
+        user = known_users.get(line_user_id)
+    else:
+        user = User.query.filter_by(line_user_id=line_user_id).first()
     
     if user:
         # User exists, check for profile updates
@@ -597,27 +1146,17 @@ def add_system_log(user_id, action_text):
             user_id=current_user.id,
             recipient_id=user_id,
             line_account_id=None,
-            is_read=True,
             timestamp=datetime.utcnow()
         )
         db.session.add(system_msg)
+        conversation = touch_conversation(user_id, system_msg)
         db.session.commit()
 
         # ===== Realtime update via Socket.IO =====
-        from flask import render_template_string
         user = User.query.get(user_id)
         if user:
-            user_data = {'user_info': user, 'last_message': system_msg, 'unread_count': 0}
-            user_list_item_html = render_template_string(USER_LIST_ITEM_HTML, data=user_data)
-            message_bubble_html = render_template_string(MESSAGE_BUBBLE_HTML, msg=system_msg, current_user=current_user)
-            all_staff = User.query.filter(User.role.in_(['admin','staff','owner'])).all()
-            for staff_member in all_staff:
-                socketio.emit('update_chat', {
-                    'user_id': user.id,
-                    'recipient_id': staff_member.id,
-                    'user_list_item_html': user_list_item_html,
-                    'message_bubble_html': message_bubble_html
-                })
+            unread_counts = get_unread_counts(user.id)
+            emit_chat_update(user, conversation, [system_msg], staff_roster.online(), unread_counts)
     except Exception as e:
         db.session.rollback()
         print(f"Error saving system log: {e}")
@@ -0,0 +1,119 @@
+import re
+
+import click
+from flask.cli import AppGroup
+from markupsafe import Markup, escape
+from sqlalchemy import or_, select, literal_column, text
+from sqlalchemy.orm import joinedload
+
+from app import db
+from app.models import Message
+
+# อ็อบเจกต์ค้นหาที่สร้างด้วย SQL ตรงใน migration (ไม่มีใน model) migrations/env.py ข้ามชื่อเหล่านี้ตอน autogenerate
+SEARCH_SCHEMA_NAMES = {"message_fts", "search_vector", "ix_message_search_vector", "ix_message_text_trgm"}
+
+search_cli = AppGroup("search", help="Full-text search over chat history.")
+
+
+def dialect_name():
+    return db.engine.dialect.name
+
+
+def _fts5_phrase(query):
+    # ให้ FTS5 มองทั้งคำค้นเป็น phrase เดียว (ไม่ตีความ AND/OR/*)
+    return '"' + query.replace('"', '""') + '"'
+
+
+def _like_pattern(query):
+    escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def _match_clause(query):
+    """เงื่อนไขค้นข้อความตาม backend ของฐานข้อมูล"""
+    dialect = dialect_name()
+    if dialect == "sqlite" and len(query) >= 3:
+        # tokenizer trigram ค้นแบบ substring ได้ ใช้กับภาษาไทยที่ไม่มีช่องว่างระหว่างคำได้
+        matches = (
+            select(literal_column("rowid"))
+            .select_from(text("message_fts"))
+            .where(text("message_fts MATCH :fts_query").bindparams(fts_query=_fts5_phrase(query)))
+        )
+        return Message.id.in_(matches)
+    if dialect == "postgresql":
+        # tsvector สำหรับคำภาษาอังกฤษ/ตัวเลข, pg_trgm (ILIKE) ครอบคลุมภาษาไทย
+        return or_(
+            literal_column("message.search_vector").op("@@")(db.func.websearch_to_tsquery("simple", query)),
+            Message.text.ilike(_like_pattern(query), escape="\\"),
+        )
+    # คำค้นสั้นกว่า 3 ตัวอักษร trigram ใช้ไม่ได้ ต้อง scan แต่ยังถูกจำกัดด้วยตัวกรองอื่น
+    return Message.text.contains(query, autoescape=True)
+
+
+def search_messages(query, user_id=None, line_account_id=None, date_from=None, date_to=None,
+                    before_id=None, limit=50):
+    """ค้นข้อความ (เฉพาะ message_type = 'text') เรียงใหม่ไปเก่า คืน (messages, has_more)"""
+    query = (query or "").strip()
+    if not query:
+        return [], False
+    q = (
+        Message.query
+        .options(joinedload(Message.author), joinedload(Message.recipient))
+        .filter(Message.message_type == "text", _match_clause(query))
+    )
+    if user_id:
+        q = q.filter(or_(Message.user_id == user_id, Message.recipient_id == user_id))
+    if line_account_id:
+        q = q.filter(Message.line_account_id == line_account_id)
+    if date_from:
+        q = q.filter(Message.timestamp >= date_from)
+    if date_to:
+        q = q.filter(Message.timestamp < date_to)
+    if before_id:
+        q = q.filter(Message.id < before_id)
+    rows = q.order_by(Message.id.desc()).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
+
+
+def highlight(value, query, context=80):
+    """ตัดข้อความรอบคำค้นแรกที่พบแล้วครอบคำค้นด้วย <mark> (escape HTML ให้แล้ว)"""
+    value = value or ""
+    pattern = re.compile(re.escape(query.strip()), re.IGNORECASE) if query and query.strip() else None
+    first = pattern.search(value) if pattern else None
+    start = max(0, first.start() - context) if first else 0
+    end = min(len(value), (first.end() if first else 0) + context * 2)
+    snippet = value[start:end]
+    parts = []
+    pos = 0
+    for match in (pattern.finditer(snippet) if pattern else ()):
+        parts.append(escape(snippet[pos:match.start()]))
+        parts.append(Markup("<mark>%s</mark>") % match.group(0))
+        pos = match.end()
+    parts.append(escape(snippet[pos:]))
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if end < len(value) else ""
+    return Markup(prefix) + Markup("").join(parts) + Markup(suffix)
+
+
+@search_cli.command("rebuild")
+def rebuild_command():
+    """Backfill/rebuild the search index from the message table."""
+    dialect = dialect_name()
+    if dialect == "sqlite":
+        db.session.execute(text("INSERT INTO message_fts(message_fts) VALUES ('rebuild')"))
+        db.session.commit()
+        click.echo("Rebuilt SQLite FTS5 index message_fts.")
+    elif dialect == "postgresql":
+        # search_vector เป็น generated column จึงมีค่าครบเสมอ แค่ rebuild index และอัปเดตสถิติ
+        db.session.execute(text("REINDEX INDEX ix_message_search_vector"))
+        db.session.execute(text("REINDEX INDEX ix_message_text_trgm"))
+        db.session.commit()
+        db.session.execute(text("ANALYZE message"))
+        db.session.commit()
+        click.echo("Reindexed search_vector and trigram indexes.")
+    else:
+        click.echo(f"No search index for dialect {dialect}; searches fall back to LIKE.")
+
+
+def init_app(app):
+    app.cli.add_command(search_cli)
@@ -0,0 +1,160 @@
+import os
+import shutil
+import time
+from collections import OrderedDict
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:  # ต้องติดตั้ง boto3 เฉพาะเมื่อใช้ MEDIA_STORAGE = 's3'
+    boto3 = None
+    ClientError = Exception
+
+
+class MediaRangeError(Exception):
+    """ช่วง Range ที่ขอเกินขนาดไฟล์"""
+
+
+class LocalStorage:
+    """เก็บไฟล์ใน UPLOAD_FOLDER ของเครื่องนี้ (ค่าเริ่มต้น)"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def put_file(self, key, src_path, content_type):
+        # ย้ายไฟล์ชั่วคราวเข้าที่ด้วย rename จึงไม่มีใครเห็นไฟล์ที่เขียนไม่ครบ
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.replace(src_path, path)
+        except OSError:
+            shutil.move(src_path, path)
+
+
+class S3Storage:
+    """เก็บไฟล์ใน bucket ที่คุยภาษา S3 ได้ (AWS S3, Cloudflare R2, MinIO ฯลฯ)"""
+
+    def __init__(self, bucket, prefix="", endpoint_url=None, region_name=None, cache_control=None):
+        if boto3 is None:
+            raise RuntimeError("MEDIA_STORAGE = 's3' requires the boto3 package")
+        self.bucket = bucket
+        self.cache_control = cache_control
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region_name)
+
+    def object_key(self, key):
+        return self.prefix + key
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def put_file(self, key, src_path, content_type):
+        self.client.upload_file(
+            src_path, self.bucket, self.object_key(key),
+            ExtraArgs={"ContentType": content_type, "CacheControl": self.cache_control or "no-cache"},
+        )
+        os.remove(src_path)
+
+    def get(self, key, byte_range=None):
+        """คืน dict ของ get_object (Body, ContentLength, ContentRange, ContentType) หรือ None ถ้าไม่มีไฟล์"""
+        kwargs = {"Bucket": self.bucket, "Key": self.object_key(key)}
+        if byte_range:
+            kwargs["Range"] = byte_range
+        try:
+            return self.client.get_object(**kwargs)
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code in ("404", "NoSuchKey", "NotFound"):
+                return None
+            if code == "InvalidRange":
+                raise MediaRangeError(byte_range)
+            raise
+
+
+class MediaStorage:
+    """จุดเดียวที่ upload_image และ media_downloader ใช้เก็บไฟล์สื่อ
+
+    key ของไฟล์ใหม่ตั้งจาก sha256 ของเนื้อหา เนื้อหาของ key จึงไม่เปลี่ยนและ cache ได้ตลอดไป
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.public_base_url = None
+        self.tmp_folder = None
+        self.max_age = 31536000
+        self.max_known = 20000
+        self.missing_ttl = 30
+        # key -> (มีไฟล์หรือไม่, เวลาที่ตรวจ) ลดการเรียก exists/HEAD ตอน render
+        # ไฟล์ที่มีแล้วไม่หายไป (key ตั้งจากเนื้อหา) ส่วนผล "ไม่มี" จำไว้แค่ missing_ttl
+        # เพราะรูปย่ออาจถูกสร้างทีหลังโดย worker หรือเครื่องอื่น
+        self._known = OrderedDict()
+
+    def init_app(self, app):
+        config = app.config
+        self.max_age = config["MEDIA_CACHE_MAX_AGE"]
+        self.missing_ttl = config["MEDIA_MISSING_CACHE_TTL"]
+        if config["MEDIA_STORAGE"] == "s3":
+            self.backend = S3Storage(
+                config["MEDIA_S3_BUCKET"],
+                prefix=config.get("MEDIA_S3_PREFIX") or "",
+                endpoint_url=config.get("MEDIA_S3_ENDPOINT_URL"),
+                region_name=config.get("MEDIA_S3_REGION"),
+                cache_control=self.cache_control,
+            )
+        else:
+            self.backend = LocalStorage(config["UPLOAD_FOLDER"])
+        self.public_base_url = (config.get("MEDIA_PUBLIC_BASE_URL") or "").rstrip("/") or None
+        # ไฟล์ชั่วคราวระหว่างรับเข้า ต้องอยู่ disk เดียวกับ UPLOAD_FOLDER เพื่อให้ rename ได้ทันที
+        self.tmp_folder = config.get("MEDIA_TMP_FOLDER") or os.path.join(config["UPLOAD_FOLDER"], ".incoming")
+        os.makedirs(self.tmp_folder, exist_ok=True)
+        app.extensions["media_storage"] = self
+
+    @property
+    def cache_control(self):
+        return f"public, max-age={self.max_age}, immutable"
+
+    @property
+    def is_local(self):
+        return isinstance(self.backend, LocalStorage)
+
+    def exists(self, key):
+        entry = self._known.get(key)
+        if entry is None or (not entry[0] and time.monotonic() - entry[1] > self.missing_ttl):
+            exists = self.backend.exists(key)
+            self._remember(key, exists)
+            return exists
+        self._known.move_to_end(key)
+        return entry[0]
+
+    def put_file(self, key, src_path, content_type):
+        self.backend.put_file(key, src_path, content_type)
+        self._remember(key, True)
+
+    def url(self, key):
+        from flask import url_for
+
+        if self.public_base_url:
+            return f"{self.public_base_url}/{key}"
+        return url_for("main.media_file", key=key)
+
+    def _remember(self, key, exists):
+        self._known[key] = (exists, time.monotonic())
+        self._known.move_to_end(key)
+        while len(self._known) > self.max_known:
+            self._known.popitem(last=False)
+
+
+media_storage = MediaStorage()
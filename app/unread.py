@@ -0,0 +1,91 @@
+import logging
+
+import click
+import eventlet
+from flask.cli import AppGroup
+from sqlalchemy import text
+
+from app import db
+
+logger = logging.getLogger(__name__)
+
+unread_cli = AppGroup("unread", help="Maintain the per-staff unread counters in read_state.")
+
+# นับข้อความขาเข้า (user_id = ลูกค้า) ที่ใหม่กว่าตำแหน่งที่อ่านแล้ว ใช้ ix_message_user_id เป็นช่วง ไม่ scan ตาราง
+RECONCILE_SQL = text(
+    "UPDATE read_state SET unread_count = ("
+    " SELECT COUNT(*) FROM message m"
+    " WHERE m.user_id = read_state.user_id AND m.id > read_state.last_read_message_id"
+    ") "
+    "WHERE read_state.user_id >= :first_user_id AND read_state.user_id <= :last_user_id "
+    "AND unread_count != ("
+    " SELECT COUNT(*) FROM message m"
+    " WHERE m.user_id = read_state.user_id AND m.id > read_state.last_read_message_id"
+    ")"
+)
+
+
+def reconcile_unread_counts(batch_size=500, user_id=None):
+    """แก้ unread_count ที่คลาดจากจำนวนข้อความจริง ทำทีละช่วงของลูกค้าเพื่อไม่ถือ write lock นาน
+
+    คืนจำนวนแถวที่ถูกแก้
+    """
+    if user_id is not None:
+        ranges = [(user_id, user_id)]
+    else:
+        user_ids = [row[0] for row in db.session.execute(
+            text("SELECT DISTINCT user_id FROM read_state ORDER BY user_id"))]
+        ranges = [
+            (user_ids[i], user_ids[min(i + batch_size, len(user_ids)) - 1])
+            for i in range(0, len(user_ids), batch_size)
+        ]
+    repaired = 0
+    for first_user_id, last_user_id in ranges:
+        result = db.session.execute(RECONCILE_SQL, {"first_user_id": first_user_id, "last_user_id": last_user_id})
+        db.session.commit()
+        repaired += result.rowcount or 0
+        eventlet.sleep(0)
+    return repaired
+
+
+class UnreadReconciler:
+    """รัน reconcile_unread_counts เป็นระยะเบื้องหลัง (UNREAD_RECONCILE_INTERVAL วินาที, 0 = ปิด)"""
+
+    def __init__(self):
+        self._app = None
+        self._thread = None
+
+    def start(self, app):
+        if self._thread is not None or not app.config["UNREAD_RECONCILE_INTERVAL"]:
+            return
+        self._app = app
+        self._thread = eventlet.spawn(self._run_forever)
+
+    def _run_forever(self):
+        config = self._app.config
+        while True:
+            eventlet.sleep(config["UNREAD_RECONCILE_INTERVAL"])
+            try:
+                with self._app.app_context():
+                    repaired = reconcile_unread_counts(config["UNREAD_RECONCILE_BATCH_SIZE"])
+                if repaired:
+                    logger.warning("Repaired %d drifted unread counters", repaired)
+            except Exception:
+                logger.exception("Unread counter reconciliation failed")
+
+
+unread_reconciler = UnreadReconciler()
+
+
+@unread_cli.command("reconcile")
+@click.option("--user-id", type=int, help="Only reconcile one customer's conversation.")
+def reconcile_command(user_id):
+    """Recompute unread_count from the message table where it has drifted."""
+    from flask import current_app
+
+    repaired = reconcile_unread_counts(current_app.config["UNREAD_RECONCILE_BATCH_SIZE"], user_id=user_id)
+    click.echo(f"Repaired {repaired} unread counter(s).")
+
+
+def init_app(app):
+    app.cli.add_command(unread_cli)
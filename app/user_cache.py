@@ -0,0 +1,66 @@
+import time
+from collections import OrderedDict
+
+from sqlalchemy.orm import make_transient_to_detached
+
+from app import db
+
+
+class UserCache:
+    """แคชค่าคอลัมน์ของ User ต่อ id ให้ load_user ของ Flask-Login ไม่ต้อง query ทุก request
+
+    เก็บเป็น dict ของค่าคอลัมน์ (ไม่เก็บ instance ข้าม session) แล้ว merge(load=False) กลับเข้า session
+    route ที่แก้รหัสผ่าน/role/ลบผู้ใช้เรียก invalidate() ส่วน worker อื่นจะเห็นการเปลี่ยนแปลงเมื่อครบ ttl
+    """
+
+    def __init__(self, ttl=60, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.version = 0
+
+    def init_app(self, app):
+        self.ttl = app.config["USER_CACHE_TTL"]
+        self.max_entries = app.config["USER_CACHE_MAX_ENTRIES"]
+
+    def load(self, user_id):
+        from app.models import User
+
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            values, cached_at = entry
+            if time.monotonic() - cached_at <= self.ttl:
+                self._entries.move_to_end(user_id)
+                user = User(**values)
+                make_transient_to_detached(user)
+                return db.session.merge(user, load=False)
+            del self._entries[user_id]
+
+        # ถ้ามี invalidate() ระหว่างรอ query ค่า version จะเปลี่ยน และจะไม่เก็บค่าที่อาจเก่าแล้ว
+        version = self.version
+        user = db.session.get(User, user_id)
+        if user is not None:
+            self._store(user_id, self._values(user), version)
+        return user
+
+    @staticmethod
+    def _values(user):
+        return {column.key: getattr(user, column.key) for column in user.__mapper__.column_attrs}
+
+    def _store(self, user_id, values, version):
+        if version != self.version:
+            return
+        self._entries[user_id] = (values, time.monotonic())
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        if user_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(user_id, None)
+        self.version += 1
+
+
+user_cache = UserCache()
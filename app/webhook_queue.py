@@ -0,0 +1,239 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import closing
+
+import eventlet
+from eventlet.queue import LightQueue, Empty, Full
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_event (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    webhook_event_id TEXT NOT NULL UNIQUE,
+    line_account_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_webhook_event_status_available_at ON webhook_event (status, available_at);
+"""
+
+
+def event_key(event):
+    # LINE ใส่ webhookEventId ให้ทุก event; ถ้าไม่มี (เช่น payload ทดสอบ) ใช้ hash ของตัว event แทน
+    if event.get('webhookEventId'):
+        return event['webhookEventId']
+    raw = json.dumps(event, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    return 'sha1:' + hashlib.sha1(raw).hexdigest()
+
+
+class RecentKeys:
+    """LRU ของ webhook_event_id ที่เพิ่งรับเข้า journal ใช้ตัด redelivery ของ LINE ก่อนถึงไฟล์ SQLite
+
+    เป็นแค่ตัวกรองด่านหน้าใน process เดียว ตัวกันซ้ำจริงคือ UNIQUE ของ journal และของ message.line_message_id
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._keys = OrderedDict()
+
+    def __contains__(self, key):
+        if key in self._keys:
+            self._keys.move_to_end(key)
+            return True
+        return False
+
+    def add(self, key):
+        self._keys[key] = None
+        self._keys.move_to_end(key)
+        while len(self._keys) > self.max_entries:
+            self._keys.popitem(last=False)
+
+
+class WebhookJournal:
+    """คิว event ของ webhook ที่เก็บลงไฟล์ SQLite แยกจากฐานข้อมูลหลัก
+
+    แถวที่ status = 'processing' จะถูกดึงไปทำใหม่ได้เมื่อหมดเวลา lease (available_at)
+    จึงได้ at-least-once แม้ process ตายกลางทาง และ webhook_event_id ที่ UNIQUE ใช้กัน event ซ้ำ
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with closing(self._connect()) as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    def append(self, line_account_id, events):
+        now = time.time()
+        rows = [
+            (key, line_account_id, json.dumps(event, ensure_ascii=False), now, now)
+            for key, event in events
+        ]
+        if not rows:
+            return 0
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO webhook_event "
+                "(webhook_event_id, line_account_id, payload, available_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.execute("COMMIT")
+            return conn.total_changes - before
+
+    def claim(self, limit, lease_seconds):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, line_account_id, payload, attempts FROM webhook_event "
+                "WHERE status IN ('pending', 'processing') AND available_at <= ? ORDER BY id LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE webhook_event SET status = 'processing', attempts = attempts + 1, available_at = ? WHERE id = ?",
+                [(now + lease_seconds, row['id']) for row in rows],
+            )
+            conn.execute("COMMIT")
+        return rows
+
+    def ack(self, event_ids):
+        # เก็บแถวไว้ (ไม่มี payload) เพื่อกัน LINE ส่ง event เดิมซ้ำ จนกว่าจะ purge
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "UPDATE webhook_event SET status = 'done', payload = '', last_error = NULL WHERE id = ?",
+                [(event_id,) for event_id in event_ids],
+            )
+            conn.execute("COMMIT")
+
+    def fail(self, event_id, attempts, error, max_attempts):
+        with closing(self._connect()) as conn:
+            if attempts >= max_attempts:
+                conn.execute("UPDATE webhook_event SET status = 'dead', last_error = ? WHERE id = ?", (error, event_id))
+            else:
+                retry_at = time.time() + min(300, 2 ** attempts)
+                conn.execute(
+                    "UPDATE webhook_event SET status = 'pending', available_at = ?, last_error = ? WHERE id = ?",
+                    (retry_at, error, event_id),
+                )
+
+    def purge(self, older_than_seconds):
+        cutoff = time.time() - older_than_seconds
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM webhook_event WHERE status = 'done' AND created_at < ?", (cutoff,))
+
+    def stats(self):
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM webhook_event GROUP BY status").fetchall())
+
+
+class WebhookQueue:
+    """รับ event จาก webhook ลง journal แล้วให้ eventlet worker pool ประมวลผลเบื้องหลังทีละชุด
+
+    handler รับ list ของ (line_account_id, payload) ถ้าทั้งชุดล้มเหลวจะลองใหม่ทีละ event
+    เพื่อให้ event ที่เสียตัวเดียวไม่ลากทั้งชุดไปรอ retry
+    """
+
+    def __init__(self, app=None):
+        self.journal = None
+        self.recent = RecentKeys()
+        self._app = None
+        self._handler = None
+        self._pool = None
+        self._dispatcher = None
+        self._wakeup = LightQueue(maxsize=1)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        path = app.config.get('WEBHOOK_QUEUE_PATH') or os.path.join(app.instance_path, 'webhook_queue.db')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.journal = WebhookJournal(path)
+        self.recent.max_entries = app.config['WEBHOOK_DEDUP_CACHE_SIZE']
+        app.extensions['webhook_queue'] = self
+
+    def enqueue(self, line_account_id, events):
+        # event ที่เพิ่งเห็นใน process นี้ไม่ต้องเปิด journal เลย
+        fresh = [(key, event) for key, event in ((event_key(e), e) for e in events) if key not in self.recent]
+        if not fresh:
+            return 0
+        added = self.journal.append(line_account_id, fresh)
+        for key, _ in fresh:
+            self.recent.add(key)
+        if added:
+            try:
+                self._wakeup.put_nowait(None)
+            except Full:
+                pass
+        return added
+
+    def start(self, app, handler):
+        if self._dispatcher is not None:
+            return
+        self._app = app
+        self._handler = handler
+        self._pool = eventlet.GreenPool(app.config['WEBHOOK_WORKERS'])
+        self._dispatcher = eventlet.spawn(self._dispatch_forever)
+
+    def _dispatch_forever(self):
+        config = self._app.config
+        last_purge = 0
+        while True:
+            rows = []
+            try:
+                free = self._pool.free()
+                if free:
+                    rows = self.journal.claim(free * config['WEBHOOK_BATCH_SIZE'], config['WEBHOOK_LEASE_SECONDS'])
+                if time.time() - last_purge > 3600:
+                    self.journal.purge(config['WEBHOOK_DEDUP_RETENTION_SECONDS'])
+                    last_purge = time.time()
+            except Exception:
+                logger.exception("Webhook queue dispatcher error")
+            # แบ่งเป็นชุดละ WEBHOOK_BATCH_SIZE ตามลำดับ id (event จาก webhook เดียวกันจึงอยู่ชุดเดียวกัน)
+            batch_size = config['WEBHOOK_BATCH_SIZE']
+            for i in range(0, len(rows), batch_size):
+                self._pool.spawn_n(self._process, rows[i:i + batch_size])
+            if rows:
+                eventlet.sleep(0)
+            elif not self._pool.free():
+                eventlet.sleep(0.05)
+            else:
+                try:
+                    self._wakeup.get(timeout=config['WEBHOOK_POLL_INTERVAL'])
+                except Empty:
+                    pass
+
+    def _process(self, rows):
+        try:
+            # template ของ Socket.IO ใช้ url_for จึงต้องมี request context
+            with self._app.test_request_context():
+                self._handler([(row['line_account_id'], json.loads(row['payload'])) for row in rows])
+        except Exception as e:
+            if len(rows) > 1:
+                logger.exception("Failed to process a batch of %d webhook events, retrying one by one", len(rows))
+                for row in rows:
+                    self._process([row])
+                return
+            row = rows[0]
+            attempts = row['attempts'] + 1
+            logger.exception("Failed to process webhook event %s (attempt %d)", row['id'], attempts)
+            self.journal.fail(row['id'], attempts, str(e), self._app.config['WEBHOOK_MAX_ATTEMPTS'])
+        else:
+            self.journal.ack([row['id'] for row in rows])
@@ -1,4 +1,3 @@
-from sqlalchemy.pool import NullPool
 import os
 
 # basedir ตอนนี้จะชี้ไปที่ root ของโปรเจกต์ (MyLineBotProject)
@@ -14,15 +13,121 @@ class Config:
     
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
-    # ✅ เพิ่มบรรทัดนี้เพื่อแก้ปัญหา eventlet + SQLite lock
-    SQLALCHEMY_ENGINE_OPTIONS = {
-        "poolclass": NullPool
-    }
+    # นับจำนวน SQL ต่อ request (ส่งกลับใน header X-SQL-Query-Count) และเตือนเมื่อเกิน threshold
+    SQL_QUERY_COUNT = os.environ.get("SQL_QUERY_COUNT", "0") == "1"
+    SQL_QUERY_WARN_THRESHOLD = int(os.environ.get("SQL_QUERY_WARN_THRESHOLD", 20))
+
+    # ตัวเลือก engine ตั้งตามชนิดฐานข้อมูลใน app/database.py ค่าที่ใส่ตรงนี้จะทับค่าเหล่านั้น
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+
+    # SQLite: WAL + busy_timeout + connection pool (การเขียนใน process เดียวกันเข้าคิวกันด้วย green lock)
+    SQLITE_POOL_SIZE = int(os.environ.get("SQLITE_POOL_SIZE", 5))
+    SQLITE_POOL_OVERFLOW = int(os.environ.get("SQLITE_POOL_OVERFLOW", 10))
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+    SQLITE_SYNCHRONOUS = "NORMAL"
+
+    # PostgreSQL: ขนาด pool ต่อ worker, ตรวจ connection ก่อนใช้ และจำกัดเวลาต่อ statement
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+    DB_POOL_OVERFLOW = int(os.environ.get("DB_POOL_OVERFLOW", 10))
+    DB_POOL_TIMEOUT = 10
+    DB_POOL_RECYCLE = 1800
+    DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 15000))
     
     # แก้ไข UPLOAD_FOLDER ให้ชี้ไปที่โฟลเดอร์ uploads ที่ถูกต้อง
     UPLOAD_FOLDER = os.path.join(basedir, 'app', 'static', 'uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16 MB
 
+    # จำนวนห้องแชทต่อหน้าในรายชื่อด้านซ้ายของ chat_all
+    CONVERSATIONS_PER_PAGE = int(os.environ.get("CONVERSATIONS_PER_PAGE", 50))
+    # จำนวนข้อความต่อหน้าในหน้าต่างแชท (โหลดหน้าที่เก่ากว่าเมื่อเลื่อนขึ้น)
+    HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", 50))
+
+    # คิว webhook: ไฟล์ journal (ค่าเริ่มต้น instance/webhook_queue.db) และจำนวน eventlet worker
+    WEBHOOK_QUEUE_PATH = os.environ.get("WEBHOOK_QUEUE_PATH")
+    WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", 4))
+    WEBHOOK_MAX_ATTEMPTS = int(os.environ.get("WEBHOOK_MAX_ATTEMPTS", 8))
+    # จำนวน event สูงสุดที่ worker หนึ่งตัวประมวลผลและ commit พร้อมกัน
+    WEBHOOK_BATCH_SIZE = int(os.environ.get("WEBHOOK_BATCH_SIZE", 50))
+    WEBHOOK_LEASE_SECONDS = 120
+    WEBHOOK_POLL_INTERVAL = 1.0
+    WEBHOOK_DEDUP_RETENTION_SECONDS = 7 * 24 * 3600
+    # จำนวน webhookEventId ล่าสุดที่จำไว้ในหน่วยความจำเพื่อตัด event ซ้ำก่อนถึง journal
+    WEBHOOK_DEDUP_CACHE_SIZE = int(os.environ.get("WEBHOOK_DEDUP_CACHE_SIZE", 10000))
+
+    # แคชโปรไฟล์ LINE (ชื่อ/รูป) ลดการเรียก get_profile ทุกข้อความ
+    PROFILE_CACHE_TTL = int(os.environ.get("PROFILE_CACHE_TTL", 3600))
+    PROFILE_CACHE_MAX_ENTRIES = int(os.environ.get("PROFILE_CACHE_MAX_ENTRIES", 5000))
+
+    # connection pool (keep-alive) ที่ LINE client ทุกบัญชีใช้ร่วมกัน
+    LINE_HTTP_POOL_SIZE = int(os.environ.get("LINE_HTTP_POOL_SIZE", 20))
+    LINE_HTTP_TIMEOUT = float(os.environ.get("LINE_HTTP_TIMEOUT", 10))
+
+    # index ของ LineAccount และลูกค้า -> OA ในหน่วยความจำ ใช้เลือก OA ตอนส่งข้อความ
+    LINE_ACCOUNT_INDEX_TTL = int(os.environ.get("LINE_ACCOUNT_INDEX_TTL", 60))
+    LINE_CUSTOMER_INDEX_MAX_ENTRIES = int(os.environ.get("LINE_CUSTOMER_INDEX_MAX_ENTRIES", 50000))
+    # ลูกค้า -> OA ที่ทักเข้ามาล่าสุด ใช้ตอบกลับโดยไม่ต้อง query Conversation (วินาที)
+    # ว่างไว้ = อัตโนมัติ: ไม่มี SOCKETIO_MESSAGE_QUEUE (worker เดียว) ทุกข้อความขาเข้าผ่าน process นี้ index จึงไม่หมดอายุ
+    # ส่วนหลาย worker อ่านใหม่ทุก 10 วินาที เพราะ worker อื่นอาจรับข้อความล่าสุดจาก OA อื่น
+    # ยิ่ง TTL ยาว query ตอนส่งยิ่งน้อย แต่ถ้าหลาย worker อาจตอบจาก OA เดิมได้นานเท่า TTL
+    # (รันหลาย worker โดยไม่มี message queue ต้องตั้งค่านี้เอง)
+    LINE_CUSTOMER_INDEX_TTL = os.environ.get("LINE_CUSTOMER_INDEX_TTL")
+
+    # รูปแบบ payload ของ update_chat: "html" (server render) หรือ "json" (ให้ chat.html render เอง ขนาดเล็กกว่า)
+    REALTIME_PAYLOAD_FORMAT = os.environ.get("REALTIME_PAYLOAD_FORMAT", "html")
+
+    # Socket.IO message queue สำหรับรันหลาย worker/instance เช่น redis://localhost:6379/0
+    # ใช้ "memory://" (kombu in-process) แทน Redis ได้ตอนทดสอบบนเครื่อง
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE") or os.environ.get("REDIS_URL")
+    SOCKETIO_CHANNEL = os.environ.get("SOCKETIO_CHANNEL", "flask-socketio")
+
+    # คิวส่งข้อความออก: จำนวน worker, retry แบบ exponential backoff และ rate limit ต่อ LINE OA
+    OUTBOUND_WORKERS = int(os.environ.get("OUTBOUND_WORKERS", 8))
+    OUTBOUND_MAX_ATTEMPTS = int(os.environ.get("OUTBOUND_MAX_ATTEMPTS", 6))
+    OUTBOUND_BASE_BACKOFF = 1.0
+    OUTBOUND_MAX_BACKOFF = 120.0
+    OUTBOUND_RATE_PER_SECOND = float(os.environ.get("OUTBOUND_RATE_PER_SECOND", 20))
+    OUTBOUND_RATE_BURST = int(os.environ.get("OUTBOUND_RATE_BURST", 20))
+
+    # ดาวน์โหลดรูปจาก LINE เบื้องหลัง: จำนวน worker, ขนาด chunk และขนาดไฟล์สูงสุด
+    MEDIA_DOWNLOAD_WORKERS = int(os.environ.get("MEDIA_DOWNLOAD_WORKERS", 4))
+    MEDIA_CHUNK_SIZE = 256 * 1024
+    MEDIA_MAX_BYTES = int(os.environ.get("MEDIA_MAX_BYTES", 20 * 1024 * 1024))
+    MEDIA_MAX_ATTEMPTS = 3
+
+    # ที่เก็บไฟล์สื่อ: 'local' (UPLOAD_FOLDER) หรือ 's3' (S3/R2/MinIO ตั้ง MEDIA_S3_ENDPOINT_URL ได้)
+    MEDIA_STORAGE = os.environ.get("MEDIA_STORAGE", "local")
+    MEDIA_S3_BUCKET = os.environ.get("MEDIA_S3_BUCKET")
+    MEDIA_S3_PREFIX = os.environ.get("MEDIA_S3_PREFIX", "media")
+    MEDIA_S3_ENDPOINT_URL = os.environ.get("MEDIA_S3_ENDPOINT_URL")
+    MEDIA_S3_REGION = os.environ.get("MEDIA_S3_REGION")
+    # ถ้ามี CDN/bucket สาธารณะให้ลิงก์ไปที่นั่นตรง ๆ ไม่ต้องผ่าน /media ของแอป
+    MEDIA_PUBLIC_BASE_URL = os.environ.get("MEDIA_PUBLIC_BASE_URL")
+    MEDIA_TMP_FOLDER = os.environ.get("MEDIA_TMP_FOLDER")
+    MEDIA_CACHE_MAX_AGE = 365 * 24 * 3600
+    # จำผล "ไม่มีไฟล์" (เช่นรูปย่อที่ยังไม่ถูกสร้าง) ไว้กี่วินาทีก่อนตรวจใหม่
+    MEDIA_MISSING_CACHE_TTL = int(os.environ.get("MEDIA_MISSING_CACHE_TTL", 30))
+
+    # index ของ quick reply ในหน่วยความจำ (โหลดใหม่ทุก TTL วินาทีเผื่อแก้จาก worker อื่น)
+    QUICK_REPLY_INDEX_TTL = int(os.environ.get("QUICK_REPLY_INDEX_TTL", 300))
+    QUICK_REPLY_RESULTS_LIMIT = 10
+
+    # จำนวนผลค้นหาข้อความต่อหน้า
+    SEARCH_PAGE_SIZE = 50
+
+    # ตรวจและแก้ unread_count ที่คลาดจากจำนวนข้อความจริงเป็นระยะ (วินาที, 0 = ปิด)
+    UNREAD_RECONCILE_INTERVAL = int(os.environ.get("UNREAD_RECONCILE_INTERVAL", 6 * 3600))
+    UNREAD_RECONCILE_BATCH_SIZE = 500
+
+    # แคชผู้ใช้ที่ login อยู่ต่อ process (วินาที) การเปลี่ยนรหัสผ่าน/role/ลบผู้ใช้จาก worker อื่นมีผลภายในเวลานี้
+    USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", 60))
+    USER_CACHE_MAX_ENTRIES = 1000
+
+    # แคชรายชื่อ staff ที่ใช้วน emit (วินาที) การเพิ่ม/ลบ/เปลี่ยน role จาก worker อื่นมีผลภายในเวลานี้
+    STAFF_ROSTER_TTL = int(os.environ.get("STAFF_ROSTER_TTL", 300))
+
+    # สตาร์ท worker เบื้องหลัง (คิว webhook/ส่งข้อความ/ดาวน์โหลดรูป/reconcile) ตอนมี request แรก
+    BACKGROUND_WORKERS = True
+
     # REMEMBER to update the fallback URL when you restart ngrok.
     # --- VVVV ใส่ URL ใหม่ของคุณที่นี่ VVVV ---
     BASE_URL = os.environ.get("BASE_URL", "https://winner-line-bot-app.onrender.com") 
@@ -30,6 +135,7 @@ class Config:
 
 class DevelopmentConfig(Config):
     DEBUG = True
+    SQL_QUERY_COUNT = True
 
 
 class ProductionConfig(Config):
@@ -37,8 +143,17 @@ class ProductionConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL")
 
 
+class TestingConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    SQL_QUERY_COUNT = True
+    # tests เรียก worker function เองโดยตรง ไม่ให้ before_app_request สตาร์ท greenlet เบื้องหลัง
+    BACKGROUND_WORKERS = False
+
+
 config = {
     "development": DevelopmentConfig,
     "production": ProductionConfig,
+    "testing": TestingConfig,
     "default": DevelopmentConfig,
 }
@@ -0,0 +1,17 @@
+import os
+
+# eventlet worker หลายตัวต้องตั้ง SOCKETIO_MESSAGE_QUEUE (เช่น Redis) ให้ emit ข้าม worker ได้
+# browser ต่อ Socket.IO แบบ websocket อย่างเดียว จึงไม่ต้องใช้ sticky session ระหว่าง worker
+worker_class = "eventlet"
+# ไม่มี message queue ก็รัน worker เดียวเป็นค่าเริ่มต้น (ตั้ง WEB_CONCURRENCY เองได้)
+has_message_queue = bool(os.environ.get("SOCKETIO_MESSAGE_QUEUE") or os.environ.get("REDIS_URL"))
+workers = int(os.environ.get("WEB_CONCURRENCY", 2 if has_message_queue else 1))
+worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 1000))
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+graceful_timeout = 30
+
+
+def on_starting(server):
+    if workers > 1 and not has_message_queue:
+        server.log.warning("Running %d workers without SOCKETIO_MESSAGE_QUEUE: realtime updates will not reach clients on other workers", workers)
@@ -90,9 +90,15 @@ def run_migrations_online():
                 directives[:] = []
                 logger.info('No changes in schema detected.')
 
+    # ตาราง/คอลัมน์/index ของ full-text search สร้างด้วย SQL ตรง ไม่มีใน model จึงไม่ให้ autogenerate ลบทิ้ง
+    def include_name(name, type_, parent_names):
+        from app.search import SEARCH_SCHEMA_NAMES
+        return not (name in SEARCH_SCHEMA_NAMES or (type_ == "table" and name.startswith("message_fts_")))
+
     conf_args = current_app.extensions['migrate'].configure_args
     if conf_args.get("process_revision_directives") is None:
         conf_args["process_revision_directives"] = process_revision_directives
+    conf_args.setdefault("include_name", include_name)
 
     connectable = get_engine()
 
@@ -0,0 +1,31 @@
+"""partial index for pending media downloads
+
+`flask indexes audit` พบว่า pending_media_downloads (ตอน start) ต้อง scan ทั้งตาราง message
+index นี้มีแต่แถวที่ media_downloader ยังดาวน์โหลดไม่เสร็จ (media_url = 'line-content:<id>')
+
+Revision ID: 29f549ea040a
+Revises: ce9412fc52e4
+Create Date: 2026-10-18 18:12:40.215836
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '29f549ea040a'
+down_revision = 'ce9412fc52e4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.create_index('ix_message_media_pending', ['id'], unique=False,
+                              sqlite_where=sa.text("media_url LIKE 'line-content:%'"),
+                              postgresql_where=sa.text("media_url LIKE 'line-content:%'"))
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_index('ix_message_media_pending')
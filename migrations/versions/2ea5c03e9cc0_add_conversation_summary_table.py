@@ -0,0 +1,81 @@
+"""add conversation summary table and unread counters
+
+Revision ID: 2ea5c03e9cc0
+Revises: a27ddd4389a3
+Create Date: 2026-10-18 10:03:17.884512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2ea5c03e9cc0'
+down_revision = 'a27ddd4389a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('conversation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('line_account_id', sa.Integer(), nullable=True),
+    sa.Column('last_message_id', sa.Integer(), nullable=True),
+    sa.Column('last_message_at', sa.DateTime(), nullable=True),
+    sa.Column('last_message_type', sa.String(length=20), nullable=True),
+    sa.Column('last_message_preview', sa.String(length=255), nullable=True),
+    sa.ForeignKeyConstraint(['last_message_id'], ['message.id'], name=op.f('fk_conversation_last_message_id_message')),
+    sa.ForeignKeyConstraint(['line_account_id'], ['line_account.id'], name=op.f('fk_conversation_line_account_id_line_account')),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], name=op.f('fk_conversation_user_id_user')),
+    sa.PrimaryKeyConstraint('id', name=op.f('pk_conversation')),
+    sa.UniqueConstraint('user_id', name=op.f('uq_conversation_user_id'))
+    )
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_conversation_last_message_at'), ['last_message_at'], unique=False)
+
+    with op.batch_alter_table('read_state', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('unread_count', sa.Integer(), server_default=sa.text('0'), nullable=False))
+
+    # --- เติมข้อมูลสรุปจากข้อความที่มีอยู่ ---
+    conn = op.get_bind()
+    conn.execute(sa.text(
+        'INSERT INTO conversation (user_id, last_message_id, line_account_id) '
+        'SELECT g.id, '
+        '(SELECT m.id FROM message m WHERE m.user_id = g.id OR m.recipient_id = g.id '
+        ' ORDER BY m.timestamp DESC, m.id DESC LIMIT 1), '
+        '(SELECT m.line_account_id FROM message m WHERE m.user_id = g.id '
+        ' ORDER BY m.timestamp DESC, m.id DESC LIMIT 1) '
+        'FROM "user" g WHERE g.role = \'guest\''
+    ))
+    conn.execute(sa.text(
+        'UPDATE conversation SET '
+        'last_message_at = (SELECT m.timestamp FROM message m WHERE m.id = conversation.last_message_id), '
+        'last_message_type = (SELECT m.message_type FROM message m WHERE m.id = conversation.last_message_id), '
+        'last_message_preview = (SELECT substr(m.text, 1, 255) FROM message m '
+        " WHERE m.id = conversation.last_message_id AND m.message_type = 'text')"
+    ))
+
+    # staff ที่ยังไม่เคยเปิดห้องแชทก็ต้องมีแถวตัวนับของตัวเอง
+    conn.execute(sa.text(
+        'INSERT INTO read_state (staff_id, user_id, last_read_message_id, unread_count) '
+        'SELECT s.id, g.id, 0, 0 FROM "user" s, "user" g '
+        "WHERE s.role IN ('admin', 'staff', 'owner') AND g.role = 'guest' "
+        'AND EXISTS (SELECT 1 FROM message m WHERE m.user_id = g.id) '
+        'AND NOT EXISTS (SELECT 1 FROM read_state rs WHERE rs.staff_id = s.id AND rs.user_id = g.id)'
+    ))
+    conn.execute(sa.text(
+        'UPDATE read_state SET unread_count = '
+        '(SELECT COUNT(*) FROM message m WHERE m.user_id = read_state.user_id '
+        ' AND m.id > read_state.last_read_message_id)'
+    ))
+
+
+def downgrade():
+    with op.batch_alter_table('read_state', schema=None) as batch_op:
+        batch_op.drop_column('unread_count')
+
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_conversation_last_message_at'))
+
+    op.drop_table('conversation')
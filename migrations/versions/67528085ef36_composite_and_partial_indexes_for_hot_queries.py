@@ -0,0 +1,60 @@
+"""composite and partial indexes for hot chat queries
+
+จากผล `flask indexes audit` (EXPLAIN ของ query ใน chat_all / webhook / api_quick_replies)
+- conversation: (last_message_at, id) ให้ sidebar เดิน index ได้โดยไม่ต้อง sort
+- read_state: (user_id, staff_id, unread_count) แทน index user_id เดี่ยว (covering)
+- message: partial index ของแถวที่ delivery_status = 'pending'
+- message: ลบ ix_message_recipient_id ซึ่งซ้ำกับ prefix ของ ix_message_recipient_id_timestamp_id
+- user: role (รายชื่อ staff ที่ webhook ดึงทุก event)
+
+Revision ID: 67528085ef36
+Revises: f6302b036334
+Create Date: 2026-10-18 15:48:52.730114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '67528085ef36'
+down_revision = 'f6302b036334'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.drop_index('ix_conversation_last_message_at')
+        batch_op.create_index('ix_conversation_last_message_at_id', ['last_message_at', 'id'], unique=False,
+                              postgresql_ops={'last_message_at': 'DESC NULLS LAST', 'id': 'DESC'})
+
+    with op.batch_alter_table('read_state', schema=None) as batch_op:
+        batch_op.drop_index('ix_read_state_user_id')
+        batch_op.create_index('ix_read_state_user_id_staff_id_unread_count', ['user_id', 'staff_id', 'unread_count'], unique=False)
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_index('ix_message_recipient_id')
+        batch_op.create_index('ix_message_delivery_pending', ['id'], unique=False,
+                              sqlite_where=sa.text("delivery_status = 'pending'"),
+                              postgresql_where=sa.text("delivery_status = 'pending'"))
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.create_index('ix_user_role', ['role'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index('ix_user_role')
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_index('ix_message_delivery_pending')
+        batch_op.create_index('ix_message_recipient_id', ['recipient_id'], unique=False)
+
+    with op.batch_alter_table('read_state', schema=None) as batch_op:
+        batch_op.drop_index('ix_read_state_user_id_staff_id_unread_count')
+        batch_op.create_index('ix_read_state_user_id', ['user_id'], unique=False)
+
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.drop_index('ix_conversation_last_message_at_id')
+        batch_op.create_index('ix_conversation_last_message_at', ['last_message_at'], unique=False)
@@ -0,0 +1,101 @@
+"""single-row inbound messages with per-staff read_state
+
+Revision ID: a27ddd4389a3
+Revises: 6a97ab13a75d
+Create Date: 2026-10-18 09:12:41.532118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a27ddd4389a3'
+down_revision = '6a97ab13a75d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('read_state',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('staff_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('last_read_message_id', sa.Integer(), server_default=sa.text('0'), nullable=False),
+    sa.ForeignKeyConstraint(['staff_id'], ['user.id'], name=op.f('fk_read_state_staff_id_user')),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], name=op.f('fk_read_state_user_id_user')),
+    sa.PrimaryKeyConstraint('id', name=op.f('pk_read_state')),
+    sa.UniqueConstraint('staff_id', 'user_id', name=op.f('uq_read_state_staff_id'))
+    )
+    with op.batch_alter_table('read_state', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_read_state_user_id'), ['user_id'], unique=False)
+
+    # --- รวมแถวข้อความขาเข้าที่เคยถูกคัดลอกให้ staff ทีละคน ให้เหลือแถวเดียว ---
+    conn = op.get_bind()
+    rows = conn.execute(sa.text(
+        'SELECT m.id, m.user_id, m.recipient_id, m.is_read, m.line_account_id, m.timestamp, '
+        'm.message_type, m.text, m.media_url, m.sticker_id, m.package_id '
+        'FROM message m JOIN "user" u ON u.id = m.user_id '
+        "WHERE u.role = 'guest' ORDER BY m.id"
+    )).fetchall()
+
+    canonical = {}    # key ของเหตุการณ์ -> id ของแถวที่เก็บไว้
+    duplicate_ids = []
+    last_read = {}    # (staff_id, guest_id) -> last_read_message_id
+    for row in rows:
+        key = (row.user_id, row.line_account_id, str(row.timestamp), row.message_type,
+               row.text, row.media_url, row.sticker_id, row.package_id)
+        keep_id = canonical.setdefault(key, row.id)
+        if keep_id != row.id:
+            duplicate_ids.append(row.id)
+        if row.recipient_id is not None and row.is_read:
+            state_key = (row.recipient_id, row.user_id)
+            last_read[state_key] = max(last_read.get(state_key, 0), keep_id)
+
+    message_table = sa.table('message', sa.column('id', sa.Integer), sa.column('recipient_id', sa.Integer))
+    for start in range(0, len(duplicate_ids), 500):
+        chunk = duplicate_ids[start:start + 500]
+        conn.execute(message_table.delete().where(message_table.c.id.in_(chunk)))
+    kept_ids = list(canonical.values())
+    for start in range(0, len(kept_ids), 500):
+        chunk = kept_ids[start:start + 500]
+        conn.execute(message_table.update().where(message_table.c.id.in_(chunk)).values(recipient_id=None))
+
+    if last_read:
+        read_state_table = sa.table('read_state',
+            sa.column('staff_id', sa.Integer), sa.column('user_id', sa.Integer),
+            sa.column('last_read_message_id', sa.Integer))
+        op.bulk_insert(read_state_table, [
+            {'staff_id': staff_id, 'user_id': guest_id, 'last_read_message_id': message_id}
+            for (staff_id, guest_id), message_id in last_read.items()
+        ])
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_column('is_read')
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('is_read', sa.Boolean(), nullable=False, server_default=sa.false()))
+
+    # กระจายข้อความขาเข้ากลับเป็นหนึ่งแถวต่อ staff โดยใช้ read_state คำนวณ is_read
+    conn = op.get_bind()
+    conn.execute(sa.text(
+        'INSERT INTO message (text, timestamp, message_type, media_url, sticker_id, package_id, '
+        'user_id, line_account_id, recipient_id, is_read) '
+        'SELECT m.text, m.timestamp, m.message_type, m.media_url, m.sticker_id, m.package_id, '
+        'm.user_id, m.line_account_id, s.id, '
+        'CASE WHEN m.id <= COALESCE(rs.last_read_message_id, 0) THEN TRUE ELSE FALSE END '
+        'FROM message m '
+        'JOIN "user" s ON s.role IN (\'admin\', \'staff\', \'owner\') '
+        'LEFT JOIN read_state rs ON rs.staff_id = s.id AND rs.user_id = m.user_id '
+        'WHERE m.recipient_id IS NULL AND m.message_type != \'system\''
+    ))
+    conn.execute(sa.text("DELETE FROM message WHERE recipient_id IS NULL AND message_type != 'system'"))
+    conn.execute(sa.text('UPDATE message SET is_read = TRUE WHERE user_id IN '
+                         '(SELECT id FROM "user" WHERE role IN (\'admin\', \'staff\', \'owner\'))'))
+
+    with op.batch_alter_table('read_state', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_read_state_user_id'))
+
+    op.drop_table('read_state')
@@ -0,0 +1,36 @@
+"""add outbound delivery status to message
+
+Revision ID: ba87f01354d9
+Revises: 7b0db0675497
+Create Date: 2026-10-18 14:12:40.216903
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ba87f01354d9'
+down_revision = '7b0db0675497'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('delivery_status', sa.String(length=20), nullable=True))
+        batch_op.add_column(sa.Column('delivery_attempts', sa.Integer(), server_default=sa.text('0'), nullable=False))
+        batch_op.add_column(sa.Column('delivery_error', sa.String(length=255), nullable=True))
+
+    # ข้อความขาออกเดิมถูกส่งแบบ synchronous ไปแล้วทั้งหมด
+    op.get_bind().execute(sa.text(
+        "UPDATE message SET delivery_status = 'sent' "
+        "WHERE recipient_id IS NOT NULL AND message_type != 'system'"
+    ))
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_column('delivery_error')
+        batch_op.drop_column('delivery_attempts')
+        batch_op.drop_column('delivery_status')
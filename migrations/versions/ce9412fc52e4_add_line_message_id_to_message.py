@@ -0,0 +1,34 @@
+"""add LINE message id and webhook event id to message
+
+unique index กันข้อความขาเข้าซ้ำเมื่อ LINE ส่ง webhook เดิมมาอีกครั้ง
+
+Revision ID: ce9412fc52e4
+Revises: 67528085ef36
+Create Date: 2026-10-18 17:05:31.482907
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ce9412fc52e4'
+down_revision = '67528085ef36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('line_message_id', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('webhook_event_id', sa.String(length=64), nullable=True))
+        batch_op.create_index(batch_op.f('ix_message_line_message_id'), ['line_message_id'], unique=True)
+        batch_op.create_index(batch_op.f('ix_message_webhook_event_id'), ['webhook_event_id'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_message_webhook_event_id'))
+        batch_op.drop_index(batch_op.f('ix_message_line_message_id'))
+        batch_op.drop_column('webhook_event_id')
+        batch_op.drop_column('line_message_id')
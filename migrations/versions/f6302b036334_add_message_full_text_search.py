@@ -0,0 +1,80 @@
+"""add full-text search index for messages
+
+SQLite: FTS5 external-content table message_fts (tokenizer trigram ค้นภาษาไทยแบบ substring ได้)
+ซิงก์กับตาราง message ด้วย trigger ทุกเส้นทางที่เขียนข้อความ (webhook, ส่งข้อความ, system log)
+PostgreSQL: generated column search_vector + GIN index และ pg_trgm สำหรับ ILIKE
+
+หมายเหตุ: migration ใดที่ทำให้ batch mode สร้างตาราง message ใหม่ (เช่น drop column บน SQLite)
+จะทำให้ trigger หาย ต้องสร้าง trigger ใหม่แล้วรัน `flask search rebuild`
+
+Revision ID: f6302b036334
+Revises: ba87f01354d9
+Create Date: 2026-10-18 15:02:11.408236
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6302b036334'
+down_revision = 'ba87f01354d9'
+branch_labels = None
+depends_on = None
+
+
+SQLITE_UPGRADE = [
+    "CREATE VIRTUAL TABLE message_fts USING fts5("
+    "text, content='message', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER message_fts_ai AFTER INSERT ON message BEGIN "
+    "INSERT INTO message_fts(rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER message_fts_ad AFTER DELETE ON message BEGIN "
+    "INSERT INTO message_fts(message_fts, rowid, text) VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER message_fts_au AFTER UPDATE OF text ON message BEGIN "
+    "INSERT INTO message_fts(message_fts, rowid, text) VALUES ('delete', old.id, old.text); "
+    "INSERT INTO message_fts(rowid, text) VALUES (new.id, new.text); END",
+    "INSERT INTO message_fts(message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_DOWNGRADE = [
+    "DROP TRIGGER IF EXISTS message_fts_au",
+    "DROP TRIGGER IF EXISTS message_fts_ad",
+    "DROP TRIGGER IF EXISTS message_fts_ai",
+    "DROP TABLE IF EXISTS message_fts",
+]
+
+POSTGRES_UPGRADE = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "ALTER TABLE message ADD COLUMN search_vector tsvector "
+    "GENERATED ALWAYS AS (to_tsvector('simple', coalesce(text, ''))) STORED",
+    "CREATE INDEX ix_message_search_vector ON message USING gin (search_vector)",
+    "CREATE INDEX ix_message_text_trgm ON message USING gin (text gin_trgm_ops)",
+]
+
+POSTGRES_DOWNGRADE = [
+    "DROP INDEX IF EXISTS ix_message_text_trgm",
+    "DROP INDEX IF EXISTS ix_message_search_vector",
+    "ALTER TABLE message DROP COLUMN IF EXISTS search_vector",
+]
+
+
+def _run(statements):
+    conn = op.get_bind()
+    for statement in statements:
+        conn.execute(sa.text(statement))
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        _run(SQLITE_UPGRADE)
+    elif dialect == 'postgresql':
+        _run(POSTGRES_UPGRADE)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        _run(SQLITE_DOWNGRADE)
+    elif dialect == 'postgresql':
+        _run(POSTGRES_DOWNGRADE)
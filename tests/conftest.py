@@ -0,0 +1,134 @@
+import os
+import shutil
+
+import pytest
+from flask.testing import FlaskClient
+from flask_migrate import upgrade
+from linebot.models import Profile
+
+from app import create_app, db
+from app.line_clients import line_clients
+from app.line_profiles import profile_cache
+from app.models import User, LineAccount
+from app.quick_replies import quick_reply_index
+from app.realtime import staff_roster
+from app.storage import media_storage
+from app.user_cache import user_cache
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.dirname(__file__)), "migrations")
+
+
+def make_app(db_path, tmp_path, **overrides):
+    test_config = {
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{db_path}",
+        "WEBHOOK_QUEUE_PATH": str(tmp_path / "webhook_queue.db"),
+        "UPLOAD_FOLDER": str(tmp_path / "uploads"),
+    }
+    test_config.update(overrides)
+    return create_app("testing", test_config)
+
+
+@pytest.fixture(scope="session")
+def template_db(tmp_path_factory):
+    # สร้าง schema ด้วย migration จริงครั้งเดียว (รวม FTS5 trigger) แล้วคัดลอกไฟล์ให้แต่ละ test
+    tmp_path = tmp_path_factory.mktemp("template")
+    path = tmp_path / "app.db"
+    app = make_app(path, tmp_path)
+    with app.app_context():
+        upgrade(directory=MIGRATIONS)
+        db.engine.dispose()
+    return path
+
+
+def reset_caches():
+    # cache ระดับ process อยู่ข้าม app ของแต่ละ test
+    staff_roster.invalidate()
+    staff_roster._sessions.clear()
+    user_cache.invalidate()
+    line_clients.invalidate()
+    profile_cache.invalidate()
+    quick_reply_index.invalidate()
+    media_storage._known.clear()
+
+
+@pytest.fixture
+def app(template_db, tmp_path):
+    db_path = tmp_path / "app.db"
+    shutil.copy(template_db, db_path)
+    reset_caches()
+    app = make_app(db_path, tmp_path)
+    with app.app_context():
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+    reset_caches()
+
+
+class IsolatedClient(FlaskClient):
+    """fixture app ค้าง app context ไว้ทั้ง test ทุก request จึงใช้ session เดียวกัน
+    ปิด session ก่อนแต่ละ request ให้เริ่มจาก session ว่างเหมือนใน production (อ็อบเจกต์เดิมจะ detach)
+    """
+
+    def open(self, *args, **kwargs):
+        db.session.remove()
+        return super().open(*args, **kwargs)
+
+
+@pytest.fixture
+def client(app):
+    app.test_client_class = IsolatedClient
+    return app.test_client()
+
+
+@pytest.fixture
+def line_account(app):
+    acc = LineAccount(name="OA", channel_id="1", channel_secret="secret", channel_access_token="token")
+    db.session.add(acc)
+    db.session.commit()
+    return acc
+
+
+@pytest.fixture
+def staff(app):
+    user = User(username="agent", role="staff")
+    user.set_password("password")
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def login(client, user):
+    with client.session_transaction() as session:
+        session["_user_id"] = str(user.id)
+        session["_fresh"] = True
+
+
+class FakeLineApi:
+    """แทน LINE Messaging API ใน test: get_profile คืนชื่อจาก line user id"""
+
+    def __init__(self):
+        self.profile_calls = []
+
+    def get_profile(self, line_user_id):
+        self.profile_calls.append(line_user_id)
+        return Profile(display_name=f"customer {line_user_id}", user_id=line_user_id, picture_url=None)
+
+
+@pytest.fixture
+def line_api(monkeypatch):
+    api = FakeLineApi()
+    monkeypatch.setattr(line_clients, "get_api", lambda acc: api)
+    return api
+
+
+def message_event(line_user_id, message_id, text="hello", timestamp=1700000000000, webhook_event_id=None):
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": timestamp,
+        "webhookEventId": webhook_event_id or f"evt-{message_id}",
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": f"reply-{message_id}",
+        "source": {"type": "user", "userId": line_user_id},
+        "message": {"type": "text", "id": message_id, "text": text},
+    }
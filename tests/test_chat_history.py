@@ -0,0 +1,75 @@
+import datetime
+
+from sqlalchemy import text
+
+from app import db
+from app.index_audit import capture, explain
+from app.models import User, Message
+from app.routes import fetch_history_page
+from tests.conftest import login
+
+
+def test_chat_history_limit_is_clamped(client, staff, line_account):
+    guest = User(username="guest", line_user_id="U1", role="guest")
+    db.session.add(guest)
+    db.session.flush()
+    db.session.add_all(Message(text=f"m{i}", user_id=guest.id, line_account_id=line_account.id) for i in range(5))
+    db.session.commit()
+    guest_id = guest.id
+    login(client, staff)
+
+    for limit, expected in [(-3, 1), (0, 1), (2, 2), (1000, 5)]:
+        data = client.get(f"/api/chat_history/{guest_id}?limit={limit}").get_json()
+        assert data["count"] == expected
+
+
+def add_conversation(guest, staff, line_account, count, start):
+    # ขาเข้าและขาออกสลับกัน timestamp บางแถวซ้ำกันเพื่อให้ cursor ต้องใช้ id ตัดสิน
+    messages = []
+    for i in range(count):
+        inbound = i % 3 != 0
+        messages.append(Message(
+            text=f"{guest.username} {i}", user_id=guest.id if inbound else staff.id,
+            recipient_id=None if inbound else guest.id, line_account_id=line_account.id,
+            timestamp=start + datetime.timedelta(seconds=i // 2),
+        ))
+    db.session.add_all(messages)
+    db.session.flush()
+    return messages
+
+
+def test_history_pages_merge_both_directions_in_cursor_order(app, staff, line_account):
+    guest, other = User(username="guest", line_user_id="U1", role="guest"), User(username="other", line_user_id="U2", role="guest")
+    db.session.add_all([guest, other])
+    db.session.flush()
+    start = datetime.datetime(2024, 1, 1)
+    expected = [msg.id for msg in add_conversation(guest, staff, line_account, 23, start)]
+    add_conversation(other, staff, line_account, 10, start)
+    db.session.commit()
+
+    pages, before_ts, before_id, has_more = [], None, None, True
+    while has_more:
+        messages, has_more = fetch_history_page(guest.id, before_ts, before_id, limit=5)
+        pages.insert(0, [msg.id for msg in messages])
+        before_ts, before_id = messages[0].timestamp, messages[0].id
+    assert [len(page) for page in pages] == [3, 5, 5, 5, 5]
+    assert [msg_id for page in pages for msg_id in page] == expected
+
+
+def test_history_page_walks_the_per_side_indexes(app, staff, line_account):
+    guests = [User(username=f"guest{n}", line_user_id=f"U{n}", role="guest") for n in range(20)]
+    db.session.add_all(guests)
+    db.session.flush()
+    for guest in guests:
+        add_conversation(guest, staff, line_account, 100, datetime.datetime(2024, 1, 1))
+    db.session.commit()
+    guest_id = guests[0].id
+    db.session.execute(text("ANALYZE"))
+
+    for cursor in [(None, None), (datetime.datetime(2024, 1, 1, 0, 0, 30), 10**6)]:
+        statements = capture(lambda: fetch_history_page(guest_id, *cursor, limit=50))
+        assert len(statements) == 1
+        plan = explain(*statements[0])
+        assert not any("TEMP B-TREE" in line or "ix_message_timestamp " in line for line in plan), plan
+        assert any("ix_message_user_id_timestamp_id" in line for line in plan), plan
+        assert any("ix_message_recipient_id_timestamp_id" in line for line in plan), plan
@@ -0,0 +1,49 @@
+import eventlet
+from sqlalchemy import event
+
+from app import db
+from app.models import Message, User
+from app.realtime import staff_roster
+from app.routes import process_webhook_events
+from tests.conftest import login, message_event
+
+
+def test_concurrent_ingest_and_chat_requests_do_not_lock_the_database(app, line_account, line_api, staff):
+    # green thread สลับกันระหว่างคำสั่ง SQL เหมือนตอนมี I/O อื่นคั่นกลาง transaction ใน production
+    # ถ้าไม่มี SQLiteWriteLock ตัวที่รอใน busy handler จะบล็อกตัวที่ถือ write lock จนได้ "database is locked"
+    errors = []
+    event.listen(db.engine, "after_cursor_execute", lambda *args: eventlet.sleep(0))
+    event.listen(db.engine, "handle_error", lambda context: errors.append(str(context.original_exception)))
+
+    with app.test_request_context():
+        process_webhook_events([(line_account.id, message_event(f"U{n}", f"seed-{n}")) for n in range(3)])
+    guest_ids = [user.id for user in User.query.filter_by(role="guest").order_by(User.id)]
+    staff_roster.connected("sid-1", staff.id)
+
+    def ingest(batch):
+        with app.test_request_context():
+            process_webhook_events([
+                (line_account.id, message_event(f"U{n}", f"in-{batch}-{n}", timestamp=1700000000000 + batch))
+                for n in range(3)
+            ])
+
+    def browse_and_reply(n):
+        client = app.test_client()
+        login(client, staff)
+        guest_id = guest_ids[n % len(guest_ids)]
+        assert client.get(f"/chat_all/{guest_id}").status_code == 200
+        assert client.post(f"/chat_all/{guest_id}", data={"message": f"reply {n}"}).status_code == 302
+
+    # ไม่ได้ monkey_patch ใน test การรอ connection จาก pool จะบล็อกทั้ง OS thread
+    # จำนวน green thread จึงต้องไม่เกิน SQLITE_POOL_SIZE + SQLITE_POOL_OVERFLOW
+    # wait() ของแต่ละ GreenThread ส่ง exception ของ worker ต่อมาให้ test (waitall() กลืนไว้เฉยๆ)
+    pool = eventlet.GreenPool()
+    threads = [pool.spawn(worker, n) for n in range(5) for worker in (ingest, browse_and_reply)]
+    with eventlet.Timeout(60):
+        for thread in threads:
+            thread.wait()
+
+    assert not [error for error in errors if "locked" in error]
+    db.session.expire_all()
+    assert Message.query.filter(Message.line_message_id.like("in-%")).count() == 15
+    assert Message.query.filter(Message.text.like("reply %")).count() == 5
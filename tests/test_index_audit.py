@@ -0,0 +1,23 @@
+from app.models import Message, ReadState, User
+from app.routes import process_webhook_events
+from tests.conftest import message_event
+
+
+def test_audit_runs_every_helper_and_leaves_data_untouched(app, line_account, line_api, staff):
+    process_webhook_events([(line_account.id, message_event("U1", "100", text="hi"))])
+    guest = User.query.filter_by(line_user_id="U1").one()
+    username, read_state = guest.username, ReadState.query.filter_by(user_id=guest.id).one()
+    unread = read_state.unread_count
+
+    result = app.test_cli_runner().invoke(args=["indexes", "audit"])
+
+    assert result.exit_code == 0, result.output
+    for section in ("webhook: resolve users", "webhook: conversation + unread counters", "chat_all: mark read"):
+        assert f"== {section}" in result.output
+    assert "statement(s) flagged." in result.output
+    sections = dict(section.split("\n", 1) for section in result.output.split("== ")[1:])
+    for name in ("chat_all: history page", "api_chat_history: older page", "startup: pending media downloads"):
+        assert "!!" not in sections[name], sections[name]
+    assert User.query.filter_by(line_user_id="U1").one().username == username
+    assert ReadState.query.filter_by(user_id=guest.id).one().unread_count == unread
+    assert Message.query.count() == 1
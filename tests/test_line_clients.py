@@ -0,0 +1,58 @@
+import pytest
+
+from app import db
+from app.instrumentation import record_queries
+from app.line_clients import line_clients
+from app.models import LineAccount, Conversation, User
+from app.routes import process_webhook_events
+from tests.conftest import message_event
+
+
+def test_customer_account_follows_latest_inbound_oa_from_other_workers(app, line_account, line_api):
+    other = LineAccount(name="OA 2", channel_id="2", channel_secret="secret2", channel_access_token="token2")
+    db.session.add(other)
+    db.session.commit()
+    process_webhook_events([(line_account.id, message_event("U1", "100"))])
+    guest_id = User.query.filter_by(line_user_id="U1").one().id
+    assert line_clients.account_for_customer(guest_id).id == line_account.id
+
+    # worker อื่นรับข้อความถัดไปของลูกค้าคนนี้จาก OA 2
+    Conversation.query.filter_by(user_id=guest_id).update({"line_account_id": other.id})
+    db.session.commit()
+    assert line_clients.account_for_customer(guest_id).id == line_account.id  # ยังอยู่ใน TTL
+
+    line_clients.customer_ttl = 0
+    assert line_clients.account_for_customer(guest_id).id == other.id
+
+
+def test_failed_ingest_does_not_update_customer_account(app, line_account, line_api, monkeypatch):
+    def fail_commit():
+        raise RuntimeError("commit failed")
+
+    monkeypatch.setattr(db.session, "commit", fail_commit)
+    with pytest.raises(RuntimeError):
+        process_webhook_events([(line_account.id, message_event("U1", "100"))])
+    assert line_clients.stats()["indexed_customers"] == 0
+
+
+def test_customer_index_does_not_expire_with_a_single_worker(app, line_account, line_api):
+    assert line_clients.customer_ttl is None
+    process_webhook_events([(line_account.id, message_event("U1", "100"))])
+    guest_id, account_id = User.query.filter_by(line_user_id="U1").one().id, line_account.id
+
+    # ตอบกลับหนึ่งวันหลังลูกค้าทักมา ยังไม่ต้อง query Conversation
+    line_account_id, seen_at = line_clients._customer_accounts[guest_id]
+    line_clients._customer_accounts[guest_id] = (line_account_id, seen_at - 86400)
+    with record_queries() as statements:
+        assert line_clients.account_for_customer(guest_id).id == account_id
+    assert statements == []
+
+
+def test_customer_index_expires_when_workers_share_a_message_queue(app):
+    app.config["SOCKETIO_MESSAGE_QUEUE"] = "memory://"
+    line_clients.init_app(app)
+    assert line_clients.customer_ttl == 10
+
+    app.config["LINE_CUSTOMER_INDEX_TTL"] = "300"
+    line_clients.init_app(app)
+    assert line_clients.customer_ttl == 300
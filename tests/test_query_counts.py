@@ -0,0 +1,57 @@
+import datetime
+
+from app import db
+from app.instrumentation import record_queries
+from app.models import User, Message, Conversation, load_user
+from tests.conftest import login
+
+
+def test_load_user_issues_one_query_then_uses_cache(staff):
+    user_id = staff.id
+    db.session.expunge_all()
+
+    with record_queries() as statements:
+        user = load_user(str(user_id))
+    assert user.id == user_id
+    assert len(statements) == 1
+    assert "message" not in statements[0].lower()
+
+    db.session.expunge_all()
+    with record_queries() as statements:
+        assert load_user(str(user_id)).username == "agent"
+    assert statements == []
+
+
+def test_chat_all_get_query_count_does_not_grow_with_history(client, staff, line_account):
+    guest_ids = []
+    for n in range(5):
+        guest = User(username=f"guest{n}", line_user_id=f"U{n}", role="guest")
+        db.session.add(guest)
+        db.session.flush()
+        last = None
+        for i in range(20):
+            last = Message(text=f"m{i}", message_type="text", user_id=guest.id, line_account_id=line_account.id,
+                           timestamp=datetime.datetime(2024, 1, 1, 0, n, i))
+            db.session.add(last)
+        db.session.flush()
+        db.session.add(Conversation(user_id=guest.id, line_account_id=line_account.id, last_message_id=last.id,
+                                    last_message_at=last.timestamp, last_message_type="text",
+                                    last_message_preview=last.text))
+        guest_ids.append(guest.id)
+    db.session.commit()
+    login(client, staff)
+
+    response = client.get("/chat_all")
+    assert response.status_code == 200
+    # load_user + หน้ารายชื่อห้องแชท (query เดียวไม่ว่ากี่ห้อง)
+    assert int(response.headers["X-SQL-Query-Count"]) <= 3
+
+    # request แรกโหลด index ของ LineAccount (แคชตาม TTL) จึงวัดจากห้องถัดไป
+    assert client.get(f"/chat_all/{guest_ids[0]}").status_code == 200
+    counts = []
+    for guest_id in guest_ids[1:3]:
+        response = client.get(f"/chat_all/{guest_id}")
+        assert response.status_code == 200
+        counts.append(int(response.headers["X-SQL-Query-Count"]))
+    # จำนวนคงที่ ไม่ขึ้นกับจำนวนห้องหรือความยาวประวัติ (ไม่มี query ต่อห้อง/ต่อข้อความ)
+    assert counts[0] == counts[1] <= 7
@@ -0,0 +1,99 @@
+import json
+import shutil
+
+import eventlet
+import flask_socketio.test_client
+import kombu.transport.virtual.base
+import pytest
+from flask_socketio import SocketIO
+
+from app import db, routes, socketio
+from app.models import User
+from app.realtime import staff_roster, staff_room
+from app.routes import process_webhook_events
+from tests.conftest import login, make_app, message_event, reset_caches
+
+STAFF_COUNTS = (1, 5, 20, 40)
+
+
+@pytest.mark.parametrize("payload_format", ["html", "json"])
+def test_update_chat_bytes_grow_linearly_with_connected_staff(app, line_account, line_api, monkeypatch, payload_format):
+    # benchmark: จำนวน byte ที่ส่งออกต่อข้อความขาเข้าหนึ่งข้อความ เทียบกับจำนวน staff ที่ต่อ Socket.IO อยู่
+    # แต่ละ payload ส่งเข้าห้องส่วนตัวของ staff คนเดียว byte ที่ส่งจริงจึงเท่ากับผลรวมขนาด payload
+    app.config["REALTIME_PAYLOAD_FORMAT"] = payload_format
+    staff = [User(username=f"agent{n:02d}", role="staff") for n in range(max(STAFF_COUNTS))]
+    db.session.add_all(staff)
+    db.session.commit()
+    staff_ids = [member.id for member in staff]
+    emitted = []
+    monkeypatch.setattr(routes.socketio, "emit", lambda event, payload, to=None: emitted.append((event, payload, to)))
+
+    bytes_sent = {}
+    for count in STAFF_COUNTS:
+        staff_roster._sessions.clear()
+        for staff_id in staff_ids[:count]:
+            staff_roster.connected(f"sid-{staff_id}", staff_id)
+        emitted.clear()
+        with app.test_request_context():
+            process_webhook_events([(line_account.id, message_event(f"U{count}", f"m{count}", text="hello there"))])
+
+        assert [event for event, _, _ in emitted] == ["update_chat"] * count
+        assert sorted(to for _, _, to in emitted) == sorted(staff_room(staff_id) for staff_id in staff_ids[:count])
+        bytes_sent[count] = sum(len(json.dumps(payload).encode()) for _, payload, _ in emitted)
+
+    print(f"\nupdate_chat bytes per inbound message ({payload_format}): "
+          + ", ".join(f"{count} staff = {size}" for count, size in bytes_sent.items()))
+    per_staff = {count: size / count for count, size in bytes_sent.items()}
+    # เส้นตรง: byte ต่อ staff หนึ่งคนคงที่ (ต่างกันแค่เลข id/ตัวนับ unread) ถ้าเป็น staff² จะโตตาม count
+    assert max(per_staff.values()) <= min(per_staff.values()) * 1.1, per_staff
+
+
+@pytest.fixture
+def queue_app(template_db, tmp_path, monkeypatch):
+    # เหมือน fixture app แต่ใช้ message queue ของ kombu ในหน่วยความจำแทน Redis
+    # test ไม่ได้ eventlet.monkey_patch() เหมือน run.py จึงทำแทนเฉพาะส่วนที่ memory:// ใช้
+    # (KombuManager ตรวจว่า socket ถูก patch แล้ว และ kombu รอ queue ด้วย time.sleep)
+    monkeypatch.setattr(eventlet.patcher, "is_monkey_patched", lambda module: True)
+    monkeypatch.setattr(kombu.transport.virtual.base, "sleep", eventlet.sleep)
+    db_path = tmp_path / "app.db"
+    shutil.copy(template_db, db_path)
+    reset_caches()
+    app = make_app(db_path, tmp_path, SOCKETIO_MESSAGE_QUEUE="memory://")
+    with app.app_context():
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+    listener = getattr(socketio.server.manager, "thread", None)
+    if listener is not None and listener.g is not None:
+        listener.g.kill()
+    reset_caches()
+
+
+def test_emit_from_another_process_reaches_staff_room_through_message_queue(queue_app, monkeypatch):
+    staff = User(username="agent", role="staff")
+    db.session.add(staff)
+    db.session.commit()
+    client = queue_app.test_client()
+    login(client, staff)
+    # test client ของ Flask-SocketIO ปฏิเสธ PubSubManager ทุกชนิด ปิดแค่การตรวจนี้
+    # KombuManager ของ app ยังฟัง queue แล้วส่ง packet ต่อให้ client เหมือนเดิม
+    monkeypatch.setattr(flask_socketio.test_client, "PubSubManager", type("NoPubSubManager", (), {}))
+    # test client เรียก manager.initialize() เอง กันไม่ให้ server เริ่ม listener ตัวที่สองตอน connect
+    socketio.server.manager_initialized = True
+    socket = socketio.test_client(queue_app, flask_test_client=client)
+    assert socket.is_connected()
+    # ให้ listener ของ KombuManager ผูก queue กับ exchange ก่อน (fanout ไม่เก็บข้อความที่ส่งก่อนหน้า)
+    eventlet.sleep(0.1)
+
+    # เช่น worker อื่นหรือ background job ที่ต่อ message queue เดียวกันแบบส่งอย่างเดียว
+    other_worker = SocketIO(message_queue="memory://", channel=queue_app.config["SOCKETIO_CHANNEL"], write_only=True)
+    other_worker.emit("update_chat", {"user_id": 1, "recipient_id": staff.id}, to=staff_room(staff.id))
+    other_worker.emit("update_chat", {"user_id": 1, "recipient_id": 0}, to=staff_room(0))
+
+    received = []
+    with eventlet.Timeout(5, False):
+        while not received:
+            eventlet.sleep(0.05)
+            received = socket.get_received()
+    assert [(packet["name"], packet["args"][0]["recipient_id"]) for packet in received] == [("update_chat", staff.id)]
+    socket.disconnect()
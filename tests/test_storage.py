@@ -0,0 +1,21 @@
+import os
+
+from app.storage import media_storage
+
+
+def test_missing_media_is_rechecked_after_ttl(app):
+    key = "ab/abcdef_thumb.jpg"
+    assert not media_storage.exists(key)
+
+    # worker อื่นสร้างรูปย่อขึ้นมาทีหลัง
+    path = media_storage.backend.path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"jpeg")
+    assert not media_storage.exists(key)  # ยังอยู่ใน MEDIA_MISSING_CACHE_TTL
+
+    media_storage.missing_ttl = 0
+    assert media_storage.exists(key)
+
+    os.remove(path)
+    assert media_storage.exists(key)  # ผล "มีไฟล์" จำไว้ตลอด (key ตั้งจากเนื้อหา)
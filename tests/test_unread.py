@@ -0,0 +1,62 @@
+from sqlalchemy import event
+
+from app import db
+from app.models import User, Message, ReadState
+from app.routes import mark_conversation_read, process_webhook_events
+from app.unread import reconcile_unread_counts
+from tests.conftest import message_event
+
+
+def test_reconcile_is_a_no_op_right_after_ingest(app, staff, line_account, line_api):
+    # ลูกค้าเก่าที่มีประวัติอยู่แล้ว แต่ staff คนนี้ยังไม่เคยมี ReadState ของห้องนี้
+    guest = User(username="old customer", line_user_id="U1", role="guest")
+    db.session.add(guest)
+    db.session.flush()
+    db.session.add_all(Message(text=f"old {i}", user_id=guest.id, line_account_id=line_account.id) for i in range(28))
+    db.session.commit()
+
+    process_webhook_events([(line_account.id, message_event("U1", "100"))])
+    state = ReadState.query.filter_by(staff_id=staff.id, user_id=guest.id).one()
+    assert state.unread_count == 1
+
+    assert reconcile_unread_counts() == 0
+    db.session.refresh(state)
+    assert state.unread_count == 1
+
+
+def test_reconcile_repairs_drifted_counter(app, staff, line_account, line_api):
+    process_webhook_events([(line_account.id, message_event("U1", str(100 + i))) for i in range(3)])
+    state = ReadState.query.filter_by(staff_id=staff.id).one()
+    state.unread_count = 42
+    db.session.commit()
+
+    assert reconcile_unread_counts() == 1
+    db.session.refresh(state)
+    assert state.unread_count == 3
+
+
+def test_mark_read_keeps_messages_committed_after_it_read_the_last_id(app, staff, line_account, line_api):
+    process_webhook_events([(line_account.id, message_event("U1", "100"))])
+    guest_id = User.query.filter_by(line_user_id="U1").one().id
+    staff_id = staff.id
+
+    ingested = []
+
+    def ingest_after_max(conn, cursor, statement, *args):
+        # webhook อีกตัว (app context และ session ของตัวเอง) commit ข้อความใหม่
+        # ระหว่างที่ mark_conversation_read อ่าน MAX(id) กับตอนเขียน
+        if not ingested and statement.lstrip().upper().startswith("SELECT MAX(MESSAGE.ID)"):
+            ingested.append(True)
+            with app.app_context(), app.test_request_context():
+                process_webhook_events([(line_account.id, message_event("U1", "101"))])
+
+    event.listen(db.engine, "after_cursor_execute", ingest_after_max)
+    assert mark_conversation_read(staff_id, guest_id)
+    db.session.commit()
+    event.remove(db.engine, "after_cursor_execute", ingest_after_max)
+
+    state = ReadState.query.filter_by(staff_id=staff_id, user_id=guest_id).one()
+    newest = Message.query.filter_by(line_message_id="101").one()
+    assert state.last_read_message_id < newest.id
+    assert state.unread_count == 1
+    assert reconcile_unread_counts() == 0
@@ -0,0 +1,83 @@
+from app import db
+from app.instrumentation import record_queries
+from app.models import Message, Conversation, ReadState
+from app.routes import process_webhook_events
+from tests.conftest import message_event
+
+
+def test_inbound_message_is_stored_without_any_staff(app, line_account, line_api):
+    process_webhook_events([(line_account.id, message_event("U1", "100", text="hi"))])
+
+    msg = Message.query.filter_by(line_message_id="100").one()
+    assert msg.text == "hi"
+    assert msg.recipient_id is None
+    conversation = Conversation.query.filter_by(user_id=msg.user_id).one()
+    assert conversation.last_message_id == msg.id
+    assert ReadState.query.count() == 0
+
+
+def test_concurrent_batches_emit_only_their_own_messages(app, line_account, line_api, staff, monkeypatch):
+    import eventlet
+    from app import routes
+    from app.realtime import staff_roster
+
+    def run(events):
+        # เหมือน worker ของ webhook_queue: payload ใช้ url_for จึงต้องมี request context
+        with app.test_request_context():
+            process_webhook_events([(line_account.id, event) for event in events])
+
+    app.config["REALTIME_PAYLOAD_FORMAT"] = "json"
+    run([message_event("U1", "100", timestamp=1700000000000)])
+    staff_roster.connected("sid-1", staff.id)
+    emitted = []
+    monkeypatch.setattr(routes.socketio, "emit", lambda event, payload, to=None: emitted.append(payload))
+
+    # สองชุดของลูกค้าคนเดียวกันทำงานสลับกัน และ timestamp ของ LINE ไม่เรียงตามลำดับที่มาถึง
+    batches = {
+        "a": [message_event("U1", "201", timestamp=1700000030000), message_event("U1", "202", timestamp=1700000010000)],
+        "b": [message_event("U1", "301", timestamp=1700000020000), message_event("U1", "302", timestamp=1700000005000)],
+    }
+
+    pool = eventlet.GreenPool()
+    for events in batches.values():
+        pool.spawn(run, events)
+    pool.waitall()
+
+    db.session.expire_all()
+    ids = {
+        name: [Message.query.filter_by(line_message_id=e["message"]["id"]).one().id for e in events]
+        for name, events in batches.items()
+    }
+    assert sorted(sorted(m["id"] for m in payload["messages"]) for payload in emitted) == sorted(
+        sorted(batch_ids) for batch_ids in ids.values())
+    for payload in emitted:
+        assert payload["recipient_id"] == staff.id
+    conversation = Conversation.query.filter_by(user_id=emitted[0]["user_id"]).one()
+    assert conversation.last_message_id == ids["a"][0]
+    assert ReadState.query.filter_by(staff_id=staff.id).one().unread_count == 5
+
+
+def test_batch_inserts_all_messages_in_one_statement(app, line_account, line_api, staff):
+    events = []
+    for n in range(9):
+        event = message_event(f"U{n % 3}", f"{500 + n}", text=f"text {n}", timestamp=1700000000000 + n)
+        if n % 3 == 1:
+            event["message"] = {"type": "sticker", "id": f"{500 + n}", "packageId": "1", "stickerId": "2"}
+        elif n % 3 == 2:
+            event["message"] = {"type": "image", "id": f"{500 + n}", "contentProvider": {"type": "line"}}
+        events.append((line_account.id, event))
+
+    with record_queries() as statements:
+        process_webhook_events(events)
+
+    inserts = [s for s in statements if s.lstrip().upper().startswith("INSERT INTO MESSAGE")]
+    assert len(inserts) == 1
+    messages = {msg.line_message_id: msg for msg in Message.query}
+    assert len(messages) == 9
+    for line_message_id, event in ((e["message"]["id"], e) for _, e in events):
+        msg = messages[line_message_id]
+        assert msg.message_type == event["message"]["type"]
+        assert msg.author.line_user_id == event["source"]["userId"]
+    assert messages["501"].sticker_id == "2" and messages["501"].text is None
+    assert messages["502"].media_pending
+    assert ReadState.query.filter_by(staff_id=staff.id).count() == 3